@@ -1,13 +1,17 @@
 # -*- coding: utf8 -*-
 
+import os
+import sys
+import math
 import MySQLdb
-import gensim
+import MySQLdb.cursors
 import yaml
 import logging
 import logging.config
 import codecs
 import random
 import unicodecsv
+import multiprocessing
 
 import numpy as np
 
@@ -17,42 +21,49 @@ from scipy.cluster.hierarchy import dendrogram, linkage, fcluster
 from sklearn import metrics
 from sklearn.cluster import MiniBatchKMeans, KMeans
 from ConfigParser import SafeConfigParser
+from silhouette import sampled_silhouette, exact_silhouette
+import model_store
 
 
-def generate_embedding_file(embedding_model_name, embedding_model,
-                            embedding_type, items, cluster_label_ground_truth_file=None):
-    """Produce a file containing the embeddings of given words.
-       Produce a file containing the clustering ground truth (labels) of given words."""
-    embedding_file = 'data/{}/embeddings/{}_{}.npy'.format(dataset, embedding_model_name, embedding_type)
-    embedding_label_file = 'data/{}/embeddings/{}_{}_labels.txt'.format(dataset, embedding_model_name, embedding_type)
-    embedding_out = codecs.open(embedding_label_file, 'w', encoding='utf-8')
-    embeddings = []
+def _embedding_file(embedding_model_name, embedding_type):
+    return 'data/{}/embeddings/{}_{}.npy'.format(dataset, embedding_model_name, embedding_type)
 
-    if cluster_label_ground_truth_file:
-        cluster_labels = []
-        for _ in xrange(len(items[0]) - 1):
-            cluster_labels.append([])
-
-    counter = 0
-    for item in items:
-        if item[0] in embedding_model and -1 not in item[1:]:
-            counter += 1
-            embeddings.append(embedding_model[item[0]])
-            embedding_out.write(u'{}\n'.format(item[0]))
-            for i, x in enumerate(item[1:]):
-                cluster_labels[i].append(str(x))
-
-    np.save(embedding_file, np.array(embeddings))
-    embedding_out.close()
-
-    logger.info('{} {} saved at {}'.format(counter, embedding_type, embedding_file))
+
+def _embedding_label_file(embedding_model_name, embedding_type):
+    return 'data/{}/embeddings/{}_{}_labels.txt'.format(dataset, embedding_model_name, embedding_type)
+
+
+def generate_embedding_file(embedding_model_name, embedding_model,
+                            embedding_type, items, cluster_label_ground_truth_file=None, dtype=np.float32):
+    """Produce a file containing the embeddings of given words (an .npy file, which can be memory-mapped), and a
+       file containing their labels.
+       Produce a file containing the clustering ground truth (labels) of given words.
+       All words are resolved to vocabulary indices in one pass, and their vectors are gathered into a preallocated
+       array of dtype (np.float16 halves the file and memory size) with one fancy-index operation."""
+    embedding_file = _embedding_file(embedding_model_name, embedding_type)
+    embedding_label_file = _embedding_label_file(embedding_model_name, embedding_type)
+
+    items = [item for item in items if -1 not in item[1:]]
+    indices = embedding_model.indices([item[0] for item in items])
+    found = np.flatnonzero(indices >= 0)
+    embeddings = np.empty((len(found), embedding_model.vectors.shape[1]), dtype=dtype)
+    np.take(embedding_model.vectors, indices[found], axis=0, out=embeddings)
+
+    np.save(embedding_file, embeddings)
+    logger.info('{} {} saved at {}'.format(len(found), embedding_type, embedding_file))
+    with codecs.open(embedding_label_file, 'w', encoding='utf-8') as embedding_label_out:
+        for i in found:
+            label = items[i][0]
+            embedding_label_out.write(u'{}\n'.format(label if isinstance(label, unicode) else label.decode('utf-8')))
     logger.info('embedding labels saved at {}'.format(embedding_label_file))
 
     if cluster_label_ground_truth_file:
+        group_n = len(items[0]) - 1 if items else 0
+        cluster_labels = np.array([items[i][1:] for i in found], dtype=np.int64).reshape(len(found), group_n).T
         cluster_label_out = codecs.open(cluster_label_ground_truth_file, 'w', encoding='utf-8')
         logger.info('cluster label ground truth saved at {}'.format(cluster_label_ground_truth_file))
         for i in xrange(len(cluster_labels)):
-            cluster_label_out.write(u'{}\n'.format(','.join(cluster_labels[i])))
+            cluster_label_out.write(u'{}\n'.format(','.join(map(str, cluster_labels[i]))))
             logger.info('cluster group {}: {} labels'.format(i, len(cluster_labels[i])))
         cluster_label_out.close()
 
@@ -77,41 +88,76 @@ def generate_embedding_file_from_csv(embedding_model_name, embedding_type, csv_f
             'data/evaluation/clustering/{}_ground_truth.txt'.format(embedding_type)
 
     embedding_model_file = 'data/{}/embeddings/{}'.format(dataset, embedding_model_name)
-    embedding_model = gensim.models.Word2Vec.load_word2vec_format(embedding_model_file, binary=True)
+    embedding_model = model_store.load(embedding_model_file, logger=logger)
     generate_embedding_file(embedding_model_name, embedding_model, embedding_type,
                             items, cluster_label_ground_truth_file)
 
 
-def generate_embedding_file_from_mysql(embedding_model_name, result_n):
-    """Read entities and relations from a MySQL db and look up their embeddings given an embedding model."""
+def _log_random(rng):
+    # log of a uniform draw in (0, 1), random() can return 0.
+    return math.log(rng.random() or sys.float_info.min)
+
+
+def _reservoir_sample(batches, k, seed=None):
+    """Uniform random sample of k rows from batches (lists) of rows, in one pass and O(k) memory.
+       Li's algorithm L: the position of the next row to enter the reservoir is drawn directly, so skipped rows cost
+       no random draw. Returns (sample, row_n), the sample has fewer than k rows if there are fewer rows."""
+    rng = random.Random(seed)
+    sample, row_n = [], 0
+    if k <= 0:
+        return sample, sum(len(batch) for batch in batches)
+    w = math.exp(_log_random(rng) / k)
+    next_row = k + int(_log_random(rng) / math.log(1.0 - w))
+    for batch in batches:
+        batch_start = row_n
+        row_n += len(batch)
+        if len(sample) < k:
+            sample.extend(batch[:k - len(sample)])
+        while next_row < row_n:
+            sample[rng.randrange(k)] = batch[next_row - batch_start]
+            w *= math.exp(_log_random(rng) / k)
+            next_row += 1 + int(_log_random(rng) / math.log(1.0 - w))
+    return sample, row_n
+
+
+def _fetch_batches(cur, batch_size=10000):
+    while True:
+        rows = cur.fetchmany(batch_size)
+        if not rows:
+            break
+        yield rows
+
+
+def generate_embedding_file_from_mysql(embedding_model_name, result_n, seed=None):
+    """Read entities and relations from a MySQL db and look up their embeddings given an embedding model.
+       result_n triples are sampled while they are streamed from the server (unsorted), so only the sample is held
+       in memory. A seed makes the sample reproducible for the same table."""
 
     def select_sql(table_name='svo'):
-        return 'SELECT DISTINCT subject_head, predicate_canonical, object_head FROM {} ORDER BY id'.format(table_name)
+        return 'SELECT DISTINCT subject_head, predicate_canonical, object_head FROM {}'.format(table_name)
 
     conn = MySQLdb.connect(**mysql_config)
-    cur = conn.cursor()
+    # Server-side cursor, the rows are read as they are fetched instead of all at once.
+    cur = conn.cursor(MySQLdb.cursors.SSCursor)
 
     try:
         cur.execute(select_sql())
+        sample, row_n = _reservoir_sample(_fetch_batches(cur), result_n, seed)
     except MySQLdb.Error, e:
         try:
             logger.error("MySQL Error [{}]: {}".format(e.args[0], e.args[1]))
         except IndexError:
             logger.error("MySQL Error: {}".format(str(e)))
     else:
-        sql_results = cur.fetchall()
-        logger.info('{} triples retrieved.'.format(len(sql_results)))
+        logger.info('{} triples retrieved.'.format(row_n))
 
-        if result_n > len(sql_results):
+        if result_n > row_n:
             logger.error('There are not so many results returned from the database!')
             exit()
 
         # Collect distinct entities and relations.
         entities, relations = set(), set()
-        # Randomly pick rows.
-        rows = random.sample(xrange(len(sql_results)), result_n)
-        for i in rows:
-            row = sql_results[i]
+        for row in sample:
             s = row[0].strip()
             p = row[1].strip()
             o = row[2].strip()
@@ -125,7 +171,7 @@ def generate_embedding_file_from_mysql(embedding_model_name, result_n):
         logger.info('{} relations retrieved'.format(len(relations)))
 
         embedding_model_file = 'data/{}/embeddings/{}'.format(dataset, embedding_model_name)
-        embedding_model = gensim.models.Word2Vec.load_word2vec_format(embedding_model_file, binary=True)
+        embedding_model = model_store.load(embedding_model_file, logger=logger)
         generate_embedding_file(embedding_model_name, embedding_model, 'entities', list(entities))
         generate_embedding_file(embedding_model_name, embedding_model, 'relations', list(relations))
     finally:
@@ -133,20 +179,18 @@ def generate_embedding_file_from_mysql(embedding_model_name, result_n):
         conn.close()
 
 
-def agglomerative_clustering(embedding_model_name, embedding_type, cluster_label_ground_truth_file,
-                             cluster_n, method='ward', metric='euclidean', plot=False):
-    embedding_file = 'data/{}/embeddings/{}_{}.npy'.format(dataset, embedding_model_name, embedding_type)
-    embeddings = np.load(embedding_file)
+def _load_embeddings(embedding_model_name, embedding_type, mmap_mode=None):
+    """Load the embeddings written by generate_embedding_file, memory-mapped if mmap_mode is given."""
+    embedding_file = _embedding_file(embedding_model_name, embedding_type)
+    embeddings = np.load(embedding_file, mmap_mode=mmap_mode)
     logger.info('Loaded embeddings from {}'.format(embedding_file))
+    return embeddings
 
-    # Start clustering.
-    logger.info('Start clustering ({}, {})...'.format(cluster_n, method))
-    t0 = time()
-    clustering = linkage(embeddings, method=method, metric=metric)
-    logger.info('Clustering time: {}s'.format(time() - t0))
 
+def _load_embedding_labels(embedding_model_name, embedding_type):
+    # Labels are kept as utf-8 strings.
     embedding_labels = []
-    embedding_label_file = 'data/{}/embeddings/{}_{}_labels.txt'.format(dataset, embedding_model_name, embedding_type)
+    embedding_label_file = _embedding_label_file(embedding_model_name, embedding_type)
     embedding_label_in = codecs.open(embedding_label_file)
     for row in embedding_label_in:
         if row:
@@ -154,41 +198,101 @@ def agglomerative_clustering(embedding_model_name, embedding_type, cluster_label
             if label:
                 embedding_labels.append(label)
     embedding_label_in.close()
-
-    cluster_label_prediction = fcluster(clustering, cluster_n, criterion='maxclust')    # 1-based index
-    # logger.info('Cluster label prediction: {}'.format(cluster_label_prediction))
-    clusters_agg = {}
-    for i in xrange(len(cluster_label_prediction)):
-        clusters_agg.setdefault(cluster_label_prediction[i] - 1, []).append(i)
+    # The embeddings and their labels are two files, a label file from another run would silently mislabel them.
+    row_n = len(np.load(_embedding_file(embedding_model_name, embedding_type), mmap_mode='r'))
+    if len(embedding_labels) != row_n:
+        raise ValueError('{} has {} labels but {} has {} embeddings.'.format(
+            embedding_label_file, len(embedding_labels), _embedding_file(embedding_model_name, embedding_type), row_n))
+    return embedding_labels
+
+
+def _save_clusters(embedding_type, embedding_labels, cluster_label_prediction):
+    """Write one line per cluster, with the comma separated labels of its members.
+       cluster_label_prediction is 0-based, empty clusters are skipped."""
+    clusters = {}
+    for i, cluster_label in enumerate(cluster_label_prediction):
+        clusters.setdefault(cluster_label, []).append(i)
     clustering_clusters_file = 'data/{}/clustering/{}_clusters.txt'.format(dataset, embedding_type)
-    cluster_out = codecs.open(clustering_clusters_file, 'w')
-    for i in xrange(len(clusters_agg)):
-        cluster_out.write(u'{}\n'.format(','.join([embedding_labels[j] for j in clusters_agg[i]])))
+    cluster_out = open(clustering_clusters_file, 'w')
+    for cluster_label in sorted(clusters):
+        # The labels are utf-8 strings.
+        cluster_out.write('{}\n'.format(','.join([embedding_labels[j] for j in clusters[cluster_label]])))
     cluster_out.close()
     logger.info('Clustering labels saved at {}'.format(clustering_clusters_file))
 
+
+def _read_cluster_label_ground_truth(cluster_label_ground_truth_file):
+    cluster_label_ground_truth = []
+    with open(cluster_label_ground_truth_file) as f:
+        for line in f:
+            if line:
+                cluster_label_ground_truth.append(map(int, line.strip().split(',')))
+    return cluster_label_ground_truth
+
+
+def _external_scores(cluster_label_ground_truth, cluster_label_prediction):
+    """(ARI, AMI, (homogeneity, completeness, V-measure)) for every ground truth cluster group."""
+    scores = []
+    for ground_truth in cluster_label_ground_truth:
+        scores.append((metrics.adjusted_rand_score(ground_truth, cluster_label_prediction),
+                       metrics.adjusted_mutual_info_score(ground_truth, cluster_label_prediction),
+                       metrics.homogeneity_completeness_v_measure(ground_truth, cluster_label_prediction)))
+    return scores
+
+
+def _evaluate(embeddings, cluster_label_prediction, cluster_label_ground_truth_file, metric='euclidean',
+              silhouette='full', silhouette_sample_size=10000, processes=1):
+    """Log the external scores against every ground truth cluster group, and return the Silhouette Coefficient.
+       silhouette is 'full' (sklearn, O(n^2) memory), 'sampled' (stratified sample of silhouette_sample_size
+       embeddings, with a 95% confidence interval), 'exact' (chunked, in processes worker processes) or None."""
     if cluster_label_ground_truth_file:
-        # Read cluster label ground truth
-        cluster_label_ground_truth = []
-        with open(cluster_label_ground_truth_file) as f:
-            for line in f:
-                if line:
-                    cluster_label_ground_truth.append(map(int, line.strip().split(',')))
+        cluster_label_ground_truth = _read_cluster_label_ground_truth(cluster_label_ground_truth_file)
 
         # Compute Ajusted Rand Index
-        for i in xrange(len(cluster_label_ground_truth)):
-            ari = metrics.adjusted_rand_score(cluster_label_ground_truth[i], cluster_label_prediction)
+        for i, (ari, ami, chv) in enumerate(_external_scores(cluster_label_ground_truth, cluster_label_prediction)):
             logger.info('Ajusted Rand Index for cluster group {}: {}'.format(i, ari))
-            ami = metrics.adjusted_mutual_info_score(cluster_label_ground_truth[i], cluster_label_prediction)
             logger.info('Ajusted Mutual Information Score for cluster group {}: {}'.format(i, ami))
-            chv = metrics.homogeneity_completeness_v_measure(cluster_label_ground_truth[i], cluster_label_prediction)
             logger.info('V-measure score for cluster group {}: {}'.format(i, chv))
 
+    if not silhouette:
+        return None
+
     # Compute Silhouette Coefficient
     t0 = time()
-    sc_score = metrics.silhouette_score(embeddings, cluster_label_prediction, metric=metric)
-    logger.info('Silhouette Coefficient: {}'.format(sc_score))
+    if silhouette == 'sampled':
+        sc_score, (sc_lower, sc_upper) = sampled_silhouette(embeddings, cluster_label_prediction,
+                                                            silhouette_sample_size, metric)
+        logger.info('Silhouette Coefficient: {} (95% CI [{}, {}], {} samples)'.format(
+            sc_score, sc_lower, sc_upper, silhouette_sample_size))
+    elif silhouette == 'exact':
+        sc_score = exact_silhouette(embeddings, cluster_label_prediction, metric, processes=processes)
+        logger.info('Silhouette Coefficient: {}'.format(sc_score))
+    else:
+        sc_score = metrics.silhouette_score(embeddings, cluster_label_prediction, metric=metric)
+        logger.info('Silhouette Coefficient: {}'.format(sc_score))
     logger.info('SC computation time: {}s'.format(time() - t0))
+    return sc_score
+
+
+def agglomerative_clustering(embedding_model_name, embedding_type, cluster_label_ground_truth_file,
+                             cluster_n, method='ward', metric='euclidean', plot=False, silhouette='full'):
+    embeddings = _load_embeddings(embedding_model_name, embedding_type)
+
+    # Start clustering.
+    logger.info('Start clustering ({}, {})...'.format(cluster_n, method))
+    t0 = time()
+    clustering = linkage(embeddings, method=method, metric=metric)
+    logger.info('Clustering time: {}s'.format(time() - t0))
+
+    embedding_labels = _load_embedding_labels(embedding_model_name, embedding_type)
+
+    cluster_label_prediction = fcluster(clustering, cluster_n, criterion='maxclust')    # 1-based index
+    # logger.info('Cluster label prediction: {}'.format(cluster_label_prediction))
+    _save_clusters(embedding_type, embedding_labels, cluster_label_prediction - 1)
+    _save_cluster_model(embedding_model_name, embedding_type, embeddings, embedding_labels,
+                        cluster_label_prediction - 1)
+
+    sc_score = _evaluate(embeddings, cluster_label_prediction, cluster_label_ground_truth_file, metric, silhouette)
 
     if plot:
         plt.rc('lines', linewidth=2)
@@ -208,10 +312,8 @@ def agglomerative_clustering(embedding_model_name, embedding_type, cluster_label
     return sc_score
 
 
-def kmeans(embedding_model, embedding_type, cluster_n, cluster_label_ground_truth_file):
-    embedding_file = 'data/{}/embeddings/{}_{}.npy'.format(dataset, embedding_model, embedding_type)
-    embeddings = np.load(embedding_file)
-    logger.info('Loaded embeddings from {}'.format(embedding_file))
+def kmeans(embedding_model, embedding_type, cluster_n, cluster_label_ground_truth_file, silhouette='full'):
+    embeddings = _load_embeddings(embedding_model, embedding_type)
 
     # Start clustering.
     logger.info('Start clustering ({})...'.format(cluster_n))
@@ -222,33 +324,257 @@ def kmeans(embedding_model, embedding_type, cluster_n, cluster_label_ground_trut
     cluster_label_prediction = k_means.labels_
     logger.info('Cluster label prediction: {}'.format(cluster_label_prediction))
 
-    # Read cluster label ground truth
-    cluster_label_ground_truth = []
-    with open(cluster_label_ground_truth_file) as f:
-        for line in f:
-            if line:
-                cluster_label_ground_truth.append(map(int, line.strip().split(',')))
+    return _evaluate(embeddings, cluster_label_prediction, cluster_label_ground_truth_file, silhouette=silhouette)
 
-    # Compute Ajusted Rand Index
-    for i in xrange(len(cluster_label_ground_truth)):
-        logger.info('Cluster label ground truth: {}'.format(cluster_label_ground_truth[i]))
-        ari = metrics.adjusted_rand_score(cluster_label_ground_truth[i], cluster_label_prediction)
-        logger.info('Ajusted Rand Index for cluster group {}: {}'.format(i, ari))
 
-    # Compute Silhouette Coefficient
+def minibatch_kmeans_clustering(embedding_model_name, embedding_type, cluster_label_ground_truth_file,
+                                cluster_n, batch_size=10000, max_iter=100, n_init=3, silhouette='sampled',
+                                silhouette_sample_size=10000, processes=1):
+    """Scalable alternative to agglomerative_clustering for hundreds of thousands to millions of embeddings,
+       e.g. to canonicalize the full KB vocabulary. Memory is linear in the number of embeddings (the embedding
+       file is memory-mapped), and the Silhouette Coefficient is estimated from a sample by default.
+       Writes the same <type>_clusters.txt file and logs the same scores."""
+    embeddings = _load_embeddings(embedding_model_name, embedding_type, mmap_mode='r')
+
+    # Start clustering.
+    logger.info('Start clustering ({}, mini-batch k-means, {} embeddings)...'.format(cluster_n, len(embeddings)))
+    mbk = MiniBatchKMeans(init='k-means++', n_clusters=cluster_n, batch_size=batch_size, max_iter=max_iter,
+                          n_init=n_init, init_size=max(3 * batch_size, 3 * cluster_n), random_state=0)
     t0 = time()
-    sc_score = metrics.silhouette_score(embeddings, cluster_label_prediction, metric='euclidean')
-    logger.info('Silhouette Coefficient: {}'.format(sc_score))
-    logger.info('SC computation time: {}s'.format(time() - t0))
-    return sc_score
+    mbk.fit(embeddings)
+    logger.info('Clustering time: {}s'.format(time() - t0))
+    cluster_label_prediction = mbk.labels_
+
+    embedding_labels = _load_embedding_labels(embedding_model_name, embedding_type)
+    _save_clusters(embedding_type, embedding_labels, cluster_label_prediction)
+    _save_cluster_model(embedding_model_name, embedding_type, embeddings, embedding_labels, cluster_label_prediction)
 
+    return _evaluate(embeddings, cluster_label_prediction, cluster_label_ground_truth_file, silhouette=silhouette,
+                     silhouette_sample_size=silhouette_sample_size, processes=processes)
+
+
+def _cached_linkage(embedding_model_name, embedding_type, embeddings, method, metric):
+    """The linkage of the embeddings, cached in the clustering directory.
+       The cache is recomputed when the embedding file is newer."""
+    linkage_file = 'data/{}/clustering/{}_{}_linkage_{}_{}.npy'.format(
+        dataset, embedding_model_name, embedding_type, method, metric)
+    embedding_file = _embedding_file(embedding_model_name, embedding_type)
+    if os.path.exists(linkage_file) and os.path.getmtime(linkage_file) >= os.path.getmtime(embedding_file):
+        logger.info('Loaded linkage from {}'.format(linkage_file))
+        return np.load(linkage_file)
+
+    logger.info('Start clustering ({})...'.format(method))
+    t0 = time()
+    clustering = linkage(embeddings, method=method, metric=metric)
+    logger.info('Clustering time: {}s'.format(time() - t0))
+    # Save under a temporary name first, so an interrupted save is never loaded.
+    tmp_linkage_file = linkage_file[:-len('.npy')] + '.tmp.npy'
+    np.save(tmp_linkage_file, clustering)
+    os.rename(tmp_linkage_file, linkage_file)
+    return clustering
+
+
+def _sweep_method(args):
+    """Cut the linkage of one method at every cluster number. Returns one result row per cluster number."""
+    (embedding_model_name, embedding_type, cluster_label_ground_truth_file, method, metric, cluster_numbers,
+     silhouette, silhouette_sample_size) = args
+    embeddings = _load_embeddings(embedding_model_name, embedding_type)
+    clustering = _cached_linkage(embedding_model_name, embedding_type, embeddings, method, metric)
+    cluster_label_ground_truth = []
+    if cluster_label_ground_truth_file:
+        cluster_label_ground_truth = _read_cluster_label_ground_truth(cluster_label_ground_truth_file)
+
+    rows = []
+    for cluster_n in cluster_numbers:
+        cluster_label_prediction = fcluster(clustering, cluster_n, criterion='maxclust')
+        row = [method, cluster_n, len(np.unique(cluster_label_prediction))]
+        if silhouette == 'sampled':
+            row.append(sampled_silhouette(embeddings, cluster_label_prediction, silhouette_sample_size, metric)[0])
+        elif silhouette == 'exact':
+            row.append(exact_silhouette(embeddings, cluster_label_prediction, metric))
+        elif silhouette:
+            row.append(metrics.silhouette_score(embeddings, cluster_label_prediction, metric=metric))
+        else:
+            row.append('')
+        for ari, ami, chv in _external_scores(cluster_label_ground_truth, cluster_label_prediction):
+            row.extend([ari, ami, chv[2]])
+        logger.info('{}'.format(', '.join(map(str, row))))
+        rows.append(row)
+    return rows
+
+
+def cross_validate(embedding_model_name, embedding_type, cluster_label_ground_truth_file, methods, cluster_numbers,
+                   result_file, metric='euclidean', silhouette='sampled', silhouette_sample_size=10000, processes=1):
+    """Sweep the agglomerative clustering parameters. The linkage of each method is computed once (and cached on
+       disk), then cut at every cluster number. Methods are run in a pool of worker processes if processes > 1.
+       The results are written to result_file as one tab separated table."""
+    tasks = [(embedding_model_name, embedding_type, cluster_label_ground_truth_file, method, metric, cluster_numbers,
+              silhouette, silhouette_sample_size) for method in methods]
+    if processes > 1:
+        pool = multiprocessing.Pool(min(processes, len(tasks)))
+        results = pool.map(_sweep_method, tasks)
+        pool.close()
+        pool.join()
+    else:
+        results = [_sweep_method(task) for task in tasks]
 
-def cross_validate(embedding_type, methods, cluster_numbers, result_file):
+    header = ['method', 'cluster_n', 'clusters', 'silhouette']
+    if cluster_label_ground_truth_file:
+        for i in xrange(len(_read_cluster_label_ground_truth(cluster_label_ground_truth_file))):
+            header.extend(['ari_{}'.format(i), 'ami_{}'.format(i), 'v_measure_{}'.format(i)])
     with open(result_file, 'w') as r_out:
-        for method in methods:
-            for cluster_n in cluster_numbers:
-                r_out.write('{}, {}, {}\n'.format(
-                    method, cluster_n, agglomerative_clustering(embedding_type, cluster_n, method)))
+        r_out.write('{}\n'.format('\t'.join(header)))
+        for rows in results:
+            for row in rows:
+                r_out.write('{}\n'.format('\t'.join(map(str, row))))
+    logger.info('Clustering results saved at {}'.format(result_file))
+
+
+def _cluster_model_file(embedding_model_name, embedding_type):
+    return 'data/{}/clustering/{}_{}_cluster_model.npz'.format(dataset, embedding_model_name, embedding_type)
+
+
+def _centroid_distances(embeddings, centroids, assignments=None, block_size=65536):
+    """Nearest centroid (or the centroid given by assignments) and euclidean distance to it of every embedding,
+       block_size embeddings at a time."""
+    centroid_norms = (centroids ** 2).sum(axis=1)
+    nearest = np.empty(len(embeddings), dtype=np.int64)
+    distances = np.empty(len(embeddings), dtype=np.float64)
+    for start in xrange(0, len(embeddings), block_size):
+        block = np.asarray(embeddings[start:start + block_size], dtype=np.float64)
+        end = start + len(block)
+        if assignments is None:
+            squared = (block ** 2).sum(axis=1)[:, np.newaxis] - 2 * block.dot(centroids.T) + centroid_norms
+            nearest[start:end] = np.argmin(squared, axis=1)
+            distances[start:end] = np.sqrt(np.maximum(squared.min(axis=1), 0))
+        else:
+            nearest[start:end] = assignments[start:end]
+            distances[start:end] = np.sqrt(((block - centroids[assignments[start:end]]) ** 2).sum(axis=1))
+    return nearest, distances
+
+
+def _save_cluster_model(embedding_model_name, embedding_type, embeddings, embedding_labels, cluster_label_prediction,
+                        block_size=65536):
+    """Save the centroids, the membership and the radius of every cluster (95th percentile of the distances of its
+       members to the centroid, at least the median over all members) for assign_to_clusters.
+       The embeddings are read block_size rows at a time, so a memory-mapped embedding file is never fully loaded."""
+    cluster_label_prediction = np.asarray(cluster_label_prediction)
+    cluster_n = cluster_label_prediction.max() + 1
+    sizes = np.bincount(cluster_label_prediction, minlength=cluster_n)
+    sums = np.zeros((cluster_n, embeddings.shape[1]), dtype=np.float64)
+    for start in xrange(0, len(embeddings), block_size):
+        np.add.at(sums, cluster_label_prediction[start:start + block_size],
+                  np.asarray(embeddings[start:start + block_size], dtype=np.float64))
+    centroids = sums / np.maximum(sizes, 1)[:, np.newaxis]
+
+    _, distances = _centroid_distances(embeddings, centroids, cluster_label_prediction, block_size)
+    radii = np.full(cluster_n, np.median(distances))
+    # The distances of the members of every cluster are contiguous once sorted by cluster.
+    order = np.argsort(cluster_label_prediction, kind='mergesort')
+    cluster_distances = np.split(distances[order], np.cumsum(sizes)[:-1])
+    for cluster in np.flatnonzero(sizes > 1):
+        radii[cluster] = max(radii[cluster], np.percentile(cluster_distances[cluster], 95))
+
+    cluster_model_file = _cluster_model_file(embedding_model_name, embedding_type)
+    np.savez(cluster_model_file, centroids=centroids, sizes=sizes, radii=radii,
+             labels=np.array(embedding_labels), assignments=cluster_label_prediction)
+    logger.info('Cluster model saved at {}'.format(cluster_model_file))
+
+
+def _save_assignments(embedding_type, labels, assignments):
+    """Write label<TAB>cluster lines, to be loaded into MySQL and joined to svo (labels use _ for spaces)."""
+    assignment_file = 'data/{}/clustering/{}_assignments.tsv'.format(dataset, embedding_type)
+    with open(assignment_file, 'w') as f:
+        for label, cluster in zip(labels, assignments):
+            f.write('{}\t{}\n'.format(label, cluster))
+    logger.info('Cluster assignments saved at {}'.format(assignment_file))
+
+
+def _save_assignments_to_mysql(labels, assignments, table_name):
+    conn = MySQLdb.connect(**mysql_config)
+    cur = conn.cursor()
+    try:
+        cur.execute('CREATE TABLE IF NOT EXISTS {} (label VARCHAR(255) NOT NULL PRIMARY KEY, cluster INT NOT NULL)'
+                    .format(table_name))
+        rows = [(label, int(cluster)) for label, cluster in zip(labels, assignments)]
+        for start in xrange(0, len(rows), 10000):
+            cur.executemany('REPLACE INTO {} (label, cluster) VALUES (%s, %s)'.format(table_name),
+                            rows[start:start + 10000])
+        conn.commit()
+        logger.info('{} cluster assignments saved in MySQL table {}'.format(len(rows), table_name))
+    except MySQLdb.Error, e:
+        try:
+            logger.error("MySQL Error [{}]: {}".format(e.args[0], e.args[1]))
+        except IndexError:
+            logger.error("MySQL Error: {}".format(str(e)))
+    finally:
+        cur.close()
+        conn.close()
+
+
+def assign_to_clusters(embedding_model_name, embedding_type, items, drift_threshold=0.2, recluster_method='ward',
+                       mysql_table=None):
+    """Assign new words (e.g. the predicates of new triples) to the clusters saved by the last clustering run,
+       without clustering again. Every new embedding goes to its nearest centroid in one vectorized pass, and the
+       centroids are updated as running means.
+       The drift is the fraction of new words farther from their centroid than its radius. If it exceeds
+       drift_threshold, all words are clustered again from scratch instead (recluster_method is a linkage method,
+       or 'minibatch' for mini-batch k-means), with the same number of clusters. The embedding file of the type
+       is then overwritten with the embeddings of all the words, since the clustering functions read it.
+       The assignments of all words are written to <type>_assignments.tsv (and mysql_table if given), and
+       <type>_clusters.txt is updated. Returns the drift."""
+    with np.load(_cluster_model_file(embedding_model_name, embedding_type)) as cluster_model:
+        centroids = cluster_model['centroids']
+        sizes = cluster_model['sizes']
+        radii = cluster_model['radii']
+        labels = cluster_model['labels'].tolist()
+        assignments = cluster_model['assignments']
+
+    # Labels are kept as utf-8 strings, as in the embedding files.
+    known = set(labels)
+    new_labels = [item.encode('utf-8') if isinstance(item, unicode) else item for item in items]
+    new_labels = [label for label in new_labels if label not in known]
+    embedding_model = model_store.load('data/{}/embeddings/{}'.format(dataset, embedding_model_name), logger=logger)
+    indices = embedding_model.indices([label.decode('utf-8') for label in new_labels])
+    new_labels = [new_labels[i] for i in np.flatnonzero(indices >= 0)]
+    new_embeddings = np.asarray(embedding_model.vectors[indices[indices >= 0]], dtype=np.float64)
+    logger.info('{} new {} to assign to {} clusters'.format(len(new_labels), embedding_type, len(centroids)))
+    if not new_labels:
+        return 0.0
+
+    nearest, distances = _centroid_distances(new_embeddings, centroids)
+    drift = float(np.mean(distances > radii[nearest]))
+    logger.info('Drift: {:.3f} of the new {} are outside their cluster radius'.format(drift, embedding_type))
+
+    if drift > drift_threshold:
+        logger.warning('Drift above {}, clustering all {} again'.format(drift_threshold, embedding_type))
+        all_labels = labels + new_labels
+        generate_embedding_file(embedding_model_name, embedding_model, embedding_type,
+                                [[label.decode('utf-8')] for label in all_labels])
+        if recluster_method == 'minibatch':
+            minibatch_kmeans_clustering(embedding_model_name, embedding_type, None, len(centroids))
+        else:
+            agglomerative_clustering(embedding_model_name, embedding_type, None, len(centroids),
+                                     method=recluster_method, silhouette=None)
+        with np.load(_cluster_model_file(embedding_model_name, embedding_type)) as cluster_model:
+            labels = cluster_model['labels'].tolist()
+            assignments = cluster_model['assignments']
+    else:
+        new_sizes = np.bincount(nearest, minlength=len(centroids))
+        sums = centroids * sizes[:, np.newaxis]
+        np.add.at(sums, nearest, new_embeddings)
+        sizes = sizes + new_sizes
+        centroids = sums / np.maximum(sizes, 1)[:, np.newaxis]
+        labels = labels + new_labels
+        assignments = np.concatenate([assignments, nearest])
+        np.savez(_cluster_model_file(embedding_model_name, embedding_type), centroids=centroids, sizes=sizes,
+                 radii=radii, labels=np.array(labels), assignments=assignments)
+        _save_clusters(embedding_type, labels, assignments)
+
+    _save_assignments(embedding_type, labels, assignments)
+    if mysql_table:
+        _save_assignments_to_mysql(labels, assignments, mysql_table)
+    return drift
 
 
 if __name__ == '__main__':
@@ -286,15 +612,21 @@ if __name__ == '__main__':
     agglomerative_clustering(embedding_model_name, embedding_type, cluster_label_ground_truth_file,
                              20, method='ward', metric='euclidean', plot=True)
     # kmeans(embedding_model_name, 'entities', 26, cluster_label_ground_truth_file)
+    # Full KB vocabulary (hundreds of thousands of embeddings and more).
+    # minibatch_kmeans_clustering(embedding_model_name, embedding_type, cluster_label_ground_truth_file, 3000)
+
+    # Assign the predicates of new triples to the existing relation clusters.
+    # assign_to_clusters(embedding_model_name, 'relations', new_predicates, mysql_table='relation_clusters')
 
     # Cross validation for clustering parameters.
     # clustering_methods = ['single', 'complete', 'average', 'weighted', 'centroid', 'median', 'ward']
     # entity_clustering_result_file = 'data/{}/clustering/entity_clustering_results.txt'.format(dataset)
     # entity_clustering_cluster_numbers = [2, 5, 10, 20, 50, 100]
-    # cross_validate('entity_embedding', clustering_methods,
-    #                entity_clustering_cluster_numbers, entity_clustering_result_file)
+    # cross_validate(embedding_model_name, 'entities', cluster_label_ground_truth_file, clustering_methods,
+    #                entity_clustering_cluster_numbers, entity_clustering_result_file, processes=len(clustering_methods))
 
     # relation_clustering_result_file = 'data/{}/clustering/relation_clustering_results.txt'.format(dataset)
     # relation_clustering_cluter_numbers = [3000]
-    # cross_validate('relation_embedding', clustering_methods,
-    #                relation_clustering_cluter_numbers, relation_clustering_result_file)
+    # cross_validate(embedding_model_name, 'relations', cluster_label_ground_truth_file, clustering_methods,
+    #                relation_clustering_cluter_numbers, relation_clustering_result_file,
+    #                processes=len(clustering_methods))
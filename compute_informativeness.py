@@ -1,18 +1,21 @@
 # -*- coding: utf8 -*-
 
-import os
 import re
-import math
 import string
-import codecs
 import logging
 import logging.config
 import itertools
+import multiprocessing
 import nltk
 import yaml
 import cPickle
 
+import numpy as np
+
+from collections import Counter
 from textblob import TextBlob
+from corpus import iter_corpus, iter_corpus_files, iter_documents
+from packed_corpus import PackedCorpus
 
 
 class WordInformativeness(object):
@@ -23,47 +26,81 @@ class WordInformativeness(object):
         self._stopwords = set(nltk.corpus.stopwords.words('english')) if stopwords is None else stopwords
         self.logger = logger if logger else logging.getLogger()
 
-    def generate_model(self, data_dir):
+    def _count_terms(self, text):
+        """Lemma counts of a document, stopwords and words of up to 2 letters excluded."""
+        counts = Counter()
+        # Remove carriage returns, punctuations and digits
+        # regex = re.compile('\- |[%s\d\n]' % re.escape(string.punctuation))
+        # text = regex.sub(' ', text)
+        # Lemmatize
+        blob = TextBlob(text.lower())
+        for word, tag in blob.tags:
+            if word not in self._stopwords and len(word) > 2:
+                if tag.startswith('VB'):
+                    w = word.lemmatize('v')
+                elif tag.startswith('JJ') or tag.startswith('RB'):
+                    w = word.lemmatize('a')
+                else:
+                    w = word.lemmatize()
+                counts[w] += 1
+        return counts
+
+    def _count_documents(self, documents):
+        """Document count, term frequencies and document frequencies of (name, text) documents."""
+        doc_num, tf, df = 0, Counter(), Counter()
+        for filename, text in documents:
+            doc_num += 1
+            self.logger.info('Processing file {}'.format(filename))
+            counts = self._count_terms(text)
+            tf.update(counts)
+            df.update(counts.keys())
+        return doc_num, tf, df
+
+    def generate_model(self, data_dir, processes=1):
+        """Count the terms of every document, in a pool of worker processes if processes > 1. Every worker counts
+           whole corpus files (or batches of documents of a packed corpus), and the counts are summed as they come
+           back, so the model is the same whatever the number of processes."""
         self.logger.info('Generating model ...')
-        for root, _, files in os.walk(data_dir):
-            for fn in files:
-                if fn.endswith('.txt'):
-                    self._doc_num += 1
-                    doc = set()
-                    filename = os.path.join(root, fn)
-                    self.logger.info('Processing file {}'.format(filename))
-                    f_in = codecs.open(filename, encoding='utf-8')
-                    text = f_in.read()
-                    # Remove carriage returns, punctuations and digits
-                    # regex = re.compile('\- |[%s\d\n]' % re.escape(string.punctuation))
-                    # text = regex.sub(' ', text)
-                    # Lemmatize
-                    blob = TextBlob(text.lower())
-                    for word, tag in blob.tags:
-                        if word not in self._stopwords and len(word) > 2:
-                            if tag.startswith('VB'):
-                                w = word.lemmatize('v')
-                            elif tag.startswith('JJ') or tag.startswith('RB'):
-                                w = word.lemmatize('a')
-                            else:
-                                w = word.lemmatize()
-                            if w not in self.model:
-                                # 'tf': term frequency, 'df': document frequency
-                                self.model[w] = {'tf': 1, 'df': 0}
-                            else:
-                                self.model[w]['tf'] += 1
-                            doc.add(w)
-                    for w in doc:
-                        self.model[w]['df'] += 1
+        global _shared
+        tf, df = Counter(), Counter()
+        if processes > 1:
+            # The manifest of a packed corpus is read once, before the fork.
+            packed_corpus = PackedCorpus(data_dir) if PackedCorpus.is_packed(data_dir) else None
+            _shared = (self, packed_corpus)
+            pool = multiprocessing.Pool(processes)
+            results = pool.imap_unordered(_count_task, _corpus_tasks(data_dir, packed_corpus))
+        else:
+            pool = None
+            results = [self._count_documents((name, f.read()) for name, f in iter_corpus(data_dir))]
+        try:
+            for doc_num, task_tf, task_df in results:
+                self._doc_num += doc_num
+                tf.update(task_tf)
+                df.update(task_df)
+        finally:
+            _shared = None
+            if pool:
+                pool.close()
+                pool.join()
 
         self.logger.info('Computing idf ...')
-        for word in self.model:
-            idf = math.log(1 + float(self._doc_num) / self.model[word]['df'])
-            self.model[word]['idf'] = idf
-            self.logger.debug(u'IDF ({}): {}'.format(word, str(idf)))
-            x_i = self.model[word]['tf'] - self.model[word]['df']
-            self.model[word]['x^I'] = x_i
-            self.logger.debug(u'x^I ({}): {}'.format(word, str(x_i)))
+        self._compute_idf(tf, df)
+
+    def _compute_idf(self, tf, df):
+        """'tf': term frequency, 'df': document frequency, 'idf' and 'x^I' (tf - df) of every word, computed over
+           arrays."""
+        words = list(tf)
+        tf = np.array([tf[word] for word in words], dtype=np.int64)
+        df = np.array([df[word] for word in words], dtype=np.int64)
+        idf = np.log(1.0 + float(self._doc_num) / df)
+        x_i = tf - df
+        debug = self.logger.isEnabledFor(logging.DEBUG)
+        for word, word_tf, word_df, word_idf, word_x_i in itertools.izip(words, tf.tolist(), df.tolist(),
+                                                                         idf.tolist(), x_i.tolist()):
+            self.model[word] = {'tf': word_tf, 'df': word_df, 'idf': word_idf, 'x^I': word_x_i}
+            if debug:
+                self.logger.debug(u'IDF ({}): {}'.format(word, str(word_idf)))
+                self.logger.debug(u'x^I ({}): {}'.format(word, str(word_x_i)))
 
     def save_model(self, filename):
         with open(filename, 'w') as model_file:
@@ -77,7 +114,31 @@ class WordInformativeness(object):
         return model
 
 
-def compute_idf():
+def _corpus_tasks(data_dir, packed_corpus=None, batch_size=1000):
+    # The corpus files, or batches of doc ids of a packed corpus.
+    if packed_corpus is not None:
+        doc_ids = packed_corpus.doc_ids()
+        return [doc_ids[i:i + batch_size] for i in xrange(0, len(doc_ids), batch_size)]
+    return list(iter_corpus_files(data_dir))
+
+
+def _task_documents(packed_corpus, task):
+    if packed_corpus is not None:
+        return packed_corpus.documents(doc_ids=task)
+    return ((name, f.read()) for name, f in iter_documents(task))
+
+
+# Set before the pool is forked, so the workers share the model settings and the packed corpus index instead of
+# receiving a pickled copy.
+_shared = None
+
+
+def _count_task(task):
+    wi, packed_corpus = _shared
+    return wi._count_documents(_task_documents(packed_corpus, task))
+
+
+def compute_idf(processes=1):
     logger = logging.getLogger()
 
     # dataset = 'acl'
@@ -88,7 +149,7 @@ def compute_idf():
     model_file = 'data/{}/idf.pkl'.format(dataset)
 
     wi = WordInformativeness(logger)
-    wi.generate_model(data_dir)
+    wi.generate_model(data_dir, processes)
     wi.save_model(model_file)
 
 
@@ -119,4 +180,5 @@ if __name__ == '__main__':
         logging.config.dictConfig(yaml.load(f))
 
     compute_idf()
+    # compute_idf(processes=multiprocessing.cpu_count())
     # generate_ignored_words()
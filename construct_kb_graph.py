@@ -9,6 +9,7 @@ import begin
 
 from ConfigParser import SafeConfigParser
 from collections import Counter
+from profiling import start_profiler
 
 
 def read_triples_from_db(sql_query, db):
@@ -78,8 +79,9 @@ def construct_graph(output_file, dataset, mysql_db, min_edge_count):
 
 
 @begin.start
-def main():
-    pass
+def main(profile=None, profile_seconds=0, profile_mode='cprofile'):
+    if profile:
+        start_profiler(profile, float(profile_seconds), profile_mode)
 
 if begin.start():
     pass
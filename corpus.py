@@ -0,0 +1,88 @@
+# -*- coding: utf8 -*-
+
+import os
+import bz2
+import gzip
+import codecs
+import tarfile
+
+from packed_corpus import PackedCorpus, iter_packed_documents
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+
+_tar_extensions = ['.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz']
+_compressed_extensions = ['.gz', '.bz2', '.xz']
+
+
+def _open_compressed(filename):
+    if filename.endswith('.gz') or filename.endswith('.tgz'):
+        return gzip.open(filename, 'rb')
+    if filename.endswith('.bz2') or filename.endswith('.tbz2'):
+        return bz2.BZ2File(filename, 'rb')
+    if filename.endswith('.xz') or filename.endswith('.txz'):
+        if lzma is None:
+            raise ImportError('Reading {} requires the lzma module (backports.lzma on Python 2).'.format(filename))
+        return lzma.LZMAFile(filename, 'rb')
+    return open(filename, 'rb')
+
+
+def _strip_extension(filename, extensions):
+    for ext in sorted(extensions, key=len, reverse=True):
+        if filename.endswith(ext):
+            return filename[:-len(ext)]
+    return filename
+
+
+def is_tar_file(filename):
+    return any(filename.endswith(ext) for ext in _tar_extensions)
+
+
+def is_corpus_file(filename):
+    """Loose .txt files, compressed .txt files (.txt.gz, .txt.bz2, .txt.xz) and tar archives."""
+    return is_tar_file(filename) or _strip_extension(filename, _compressed_extensions).endswith('.txt')
+
+
+def iter_corpus_files(root):
+    for dirpath, _, files in os.walk(root):
+        for fn in files:
+            if is_corpus_file(fn):
+                yield os.path.join(dirpath, fn)
+
+
+def iter_documents(filename):
+    """Yield (name, f) for every text document in a corpus file, where f is a utf-8 stream of the document.
+       The text is decompressed on the fly, nothing is written to disk. The name of a compressed document drops
+       the compression extension, e.g. a/b.txt.gz -> a/b.txt, and a document in an archive is named after its
+       path in the archive, e.g. a/bundle.tar.gz:x/y.txt -> a/bundle/x/y.txt.
+       Each stream is only valid until the next document is requested."""
+    reader = codecs.getreader('utf-8')
+    if is_tar_file(filename):
+        archive_root = _strip_extension(filename, _tar_extensions)
+        with _open_compressed(filename) as raw:
+            # Stream mode, the members are read in archive order without seeking.
+            with tarfile.open(fileobj=raw, mode='r|') as archive:
+                for member in archive:
+                    if member.isfile() and member.name.endswith('.txt'):
+                        yield os.path.join(archive_root, member.name), reader(archive.extractfile(member))
+    else:
+        with _open_compressed(filename) as raw:
+            yield _strip_extension(filename, _compressed_extensions), reader(raw)
+
+
+def iter_corpus(root):
+    """Yield (name, f) for every text document under root, see iter_documents.
+       root can also be a packed corpus (see packed_corpus.py)."""
+    if PackedCorpus.is_packed(root):
+        for doc in iter_packed_documents(root):
+            yield doc
+        return
+    for filename in iter_corpus_files(root):
+        for doc in iter_documents(filename):
+            yield doc
@@ -0,0 +1,64 @@
+# -*- coding: utf8 -*-
+
+import re
+import hashlib
+import logging
+
+from collections import OrderedDict
+
+
+class SentenceCache(object):
+    """A memory-bounded LRU cache of extraction results, keyed by the fingerprint of the normalized sentence.
+       Repeated sentences (funding statements, license text, standard method sentences, ...) are parsed once,
+       and their relations are attributed to every later occurrence."""
+
+    _whitespace = re.compile(r'\s+', re.UNICODE)
+
+    def __init__(self, max_size=50000, logger=None):
+        self.logger = logger if logger else logging.getLogger()
+        self._max_size = int(max_size)
+        self._cache = OrderedDict()
+        self._hits = 0
+        self._misses = 0
+        self._parsed = 0
+        self._parse_time = 0.0
+
+    @classmethod
+    def fingerprint(cls, sentence):
+        normalized = cls._whitespace.sub(u' ', sentence).strip()
+        return hashlib.md5(normalized.encode('utf-8')).digest()
+
+    def get(self, sentence):
+        """Return the cached relations of the sentence, or None if it has not been seen (or was evicted)."""
+        key = self.fingerprint(sentence)
+        relations = self._cache.pop(key, None)
+        if relations is None:
+            self._misses += 1
+            return None
+        self._cache[key] = relations
+        self._hits += 1
+        return relations
+
+    def put(self, sentence, relations, parse_time):
+        """Cache the relations of a sentence that has just been parsed in parse_time seconds."""
+        self._parsed += 1
+        self._parse_time += parse_time
+        if self._max_size <= 0:
+            return
+        self._cache[self.fingerprint(sentence)] = relations
+        if len(self._cache) > self._max_size:
+            self._cache.popitem(last=False)
+
+    @property
+    def saved_time(self):
+        """Estimated parser and extraction time saved, based on the mean time of a parsed sentence."""
+        if not self._parsed:
+            return 0.0
+        return self._hits * self._parse_time / self._parsed
+
+    def report(self):
+        total = self._hits + self._misses
+        self.logger.info('Deduplication: {} sentences, {} parsed, {} duplicates ({:.1f}%)'.format(
+            total, self._parsed, self._hits, 100.0 * self._hits / total if total else 0.0))
+        self.logger.info('Deduplication: {:.1f}s spent parsing, about {:.1f}s saved'.format(
+            self._parse_time, self.saved_time))
@@ -2,10 +2,10 @@
 
 import json
 import logging
-import jsonrpclib
-import nltk
 
 from word_unit_sequence import WordUnit
+from parser_backend import get_parser
+from utils import timeit
 
 
 class DependencyGraph(object):
@@ -15,56 +15,42 @@ class DependencyGraph(object):
         self.logger = logger if logger else logging.getLogger()
         self._raw = {}
         self._tree = {}
-        self._words = []
-        self._lemmas = []
-        self._tags = []
+        self._dependencies = []
+        self._words = None
+        self._lemmas = None
+        self._tags = None
         self._tagged_text = None
         self._dep_triples = []
 
-        if not parser_server:
-            parser_server = 'http://localhost:8084'
-
-        parser = jsonrpclib.Server(parser_server)
-        self._raw = json.loads(parser.parse(self._sentence))
-        self._tree = self._raw['sentences'][0]
-        if self._tree:
-            self._parse_tree()
+        # parser_server is either the url of a CoreNLP server or a ParserBackend.
+        parser = get_parser(parser_server)
+        with timeit('parse_rpc'):
+            response = parser.parse(self._sentence)
+        with timeit('dependency_graph'):
+            self._raw = json.loads(response)
+            self._tree = self._raw['sentences'][0]
+            if self._tree:
+                self._parse_tree()
 
     def _parse_tree(self):
-        dependencies = []
-        for dep in self._dependencies():
-            dependencies.append(dep)
-        dependencies = sorted(dependencies)
+        # Only the dependency triples are built here, the other views are derived on first access.
+        # Sort by (index, word, head, rel), which is the order of sorting the full (index, word, lemma, pos, head, rel)
+        # tuples, since lemma and pos are determined by the index.
+        self._dependencies = sorted(self._tree['dependencies'], key=lambda d: (int(d[4]), d[3], d[2], d[0]))
         words = self._tree['words']
-        tagged_text = []
-        for dep in dependencies:
-            index = dep[0]
-            word = dep[1]
-            lemma = dep[2]
-            pos = dep[3]
-            head_index = int(dep[4])
-            head_word = words[head_index-1][0]
-            head_lemma = words[head_index-1][1]['Lemma']
-            head_pos = words[head_index-1][1]['PartOfSpeech']
-            rel = dep[5]
-            self._words.append(word)
-            self._lemmas.append(lemma)
-            self._tags.append(pos)
-            tagged_text.append(nltk.tree.Tree(pos, [word]))
+        for rel, _, head, word, index in self._dependencies:
             if not rel == 'root':
-                head = WordUnit(head_index, head_word, head_lemma, head_pos)
-                dependent = WordUnit(index, word, lemma, pos)
-                triple = (head, rel, dependent)
-                self._dep_triples.append(triple)
-        self._tagged_text = nltk.tree.Tree('S', tagged_text)
-
-    def _dependencies(self):
-        for rel, _, head, word, index in self._tree['dependencies']:
-            index = int(index)
-            word_info = self._tree['words'][index-1][1]
-            pos = word_info['PartOfSpeech']
-            lemma = word_info['Lemma']
-            yield index, word, lemma, pos, head, rel
+                index = int(index)
+                word_info = words[index-1][1]
+                head_index = int(head)
+                head_info = words[head_index-1]
+                head = WordUnit(head_index, head_info[0], head_info[1]['Lemma'], head_info[1]['PartOfSpeech'])
+                dependent = WordUnit(index, word, word_info['Lemma'], word_info['PartOfSpeech'])
+                self._dep_triples.append((head, rel, dependent))
+
+    def _word_info(self, key):
+        words = self._tree['words']
+        return [words[int(index)-1][1][key] for _, _, _, _, index in self._dependencies]
 
     @property
     def dep_triples(self):
@@ -72,6 +58,8 @@ class DependencyGraph(object):
 
     @property
     def text(self):
+        if self._words is None:
+            self._words = [word for _, _, _, word, _ in self._dependencies]
         return self._words
 
     @property
@@ -80,22 +68,31 @@ class DependencyGraph(object):
 
     @property
     def lemmas(self):
+        if self._lemmas is None:
+            self._lemmas = self._word_info('Lemma')
         return self._lemmas
 
     @property
     def tags(self):
+        if self._tags is None:
+            self._tags = self._word_info('PartOfSpeech')
         return self._tags
 
     @property
     def tagged_text(self):
+        if self._tagged_text is None and self._tree:
+            from nltk.tree import Tree
+            self._tagged_text = Tree('S', [Tree(pos, [word]) for word, pos in zip(self.text, self.tags)])
         return self._tagged_text
 
     def print_dep_triples(self):
-        for t in self._dep_triples:
-            self.logger.debug('{} {} {}'.format(t[0].more_info(), t[1], t[2].more_info()))
+        if self.logger.isEnabledFor(logging.DEBUG):
+            for t in self._dep_triples:
+                self.logger.debug(u'%s %s %s', t[0].more_info(), t[1], t[2].more_info())
 
     def print_raw(self):
-        self.logger.debug(json.dumps(self._raw, ensure_ascii=False, indent=4))
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(json.dumps(self._raw, ensure_ascii=False, indent=4))
 
 
 if __name__ == '__main__':
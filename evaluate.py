@@ -10,9 +10,9 @@ import numpy as np
 
 from cycler import cycler
 from matplotlib import pyplot as plt
-from gensim.models import Word2Vec
 from numpy import arange
 from extract_relations import RelationExtractor
+import model_store
 
 
 def evaluate_extraction(input_file, output_file):
@@ -118,35 +118,87 @@ def generate_entity_pairs(threshold):
     f_out.close()
 
 
-def compute_pair_similarity(benchmark_file, embedding_file, binary_embedding=True):
-    logger = logging.getLogger()
-
-    logger.info('Loading embeddings from {}...'.format(embedding_file))
-    embedding_model = Word2Vec.load_word2vec_format(embedding_file, binary=binary_embedding)
-
-    pair_similarities = {}
+def _read_pairs(benchmark_file):
+    # A repeated pair is only scored once, in the order of its first occurrence.
+    pairs, seen = [], set()
     with open(benchmark_file) as bf:
         for line in bf:
             line = line.strip()
             if line:
                 pair = tuple(line.split(','))
-                term_1, term_2 = pair
-                if term_1 in embedding_model and term_2 in embedding_model:
-                    sim_score = float(embedding_model.similarity(term_1, term_2))
-                    pair_similarities[pair] = sim_score
-
-    accuracy = []
-    for threshold in arange(0.0, 1.1, 0.1):
-        similar_pair_count = 0
-        for pair in pair_similarities:
-            if pair_similarities[pair] >= threshold:
-                similar_pair_count += 1
-        accuracy.append(float(similar_pair_count) / len(pair_similarities))
+                if pair not in seen:
+                    seen.add(pair)
+                    pairs.append(pair)
+    return pairs
+
+
+def pair_similarities(embedding_model, pairs, batch_size=100000):
+    """Cosine similarities of the pairs whose terms are both in the model (a model_store.ModelStore).
+       The terms are resolved to vocabulary indices in one pass, then the similarities are computed batch_size
+       pairs at a time with one gather and one row-wise dot product per batch."""
+    indices_1 = embedding_model.indices([pair[0] for pair in pairs])
+    indices_2 = embedding_model.indices([pair[1] for pair in pairs])
+    found = np.flatnonzero((indices_1 >= 0) & (indices_2 >= 0))
+    similarities = np.empty(len(found), dtype=np.float64)
+    for start in xrange(0, len(found), batch_size):
+        batch = found[start:start + batch_size]
+        v_1 = np.asarray(embedding_model.vectors[indices_1[batch]], dtype=np.float64)
+        v_2 = np.asarray(embedding_model.vectors[indices_2[batch]], dtype=np.float64)
+        similarities[start:start + len(batch)] = \
+            np.einsum('ij,ij->i', v_1, v_2) / (np.linalg.norm(v_1, axis=1) * np.linalg.norm(v_2, axis=1))
+    return similarities
+
+
+def similarity_accuracy(similarities, thresholds):
+    """Fraction of the pairs with a similarity >= each threshold, from one sort and a searchsorted."""
+    sorted_similarities = np.sort(similarities)
+    counts = len(sorted_similarities) - np.searchsorted(sorted_similarities, thresholds, side='left')
+    return list(counts / float(len(sorted_similarities)))
+
+
+def compute_pair_similarity(benchmark_file, embedding_file, binary_embedding=True):
+    logger = logging.getLogger()
+
+    logger.info('Loading embeddings from {}...'.format(embedding_file))
+    embedding_model = model_store.load(embedding_file, binary=binary_embedding, logger=logger)
+
+    similarities = pair_similarities(embedding_model, _read_pairs(benchmark_file))
+    accuracy = similarity_accuracy(similarities, arange(0.0, 1.1, 0.1))
 
     logger.info('Accuracy: {}'.format(accuracy))
     return accuracy
 
 
+def evaluate_pair_similarity(benchmark_files, embedding_files, result_file=None):
+    """Accuracy curves of every embedding model on every benchmark file, in one invocation.
+       embedding_files is a list of (embedding file, binary) tuples, each model is loaded once.
+       Returns {(benchmark file, embedding file): accuracy}, and writes them as a tab separated table to
+       result_file if given."""
+    logger = logging.getLogger()
+    thresholds = arange(0.0, 1.1, 0.1)
+    pairs = dict((benchmark_file, _read_pairs(benchmark_file)) for benchmark_file in benchmark_files)
+
+    results = {}
+    for embedding_file, binary_embedding in embedding_files:
+        embedding_model = model_store.load(embedding_file, binary=binary_embedding, logger=logger)
+        for benchmark_file in benchmark_files:
+            similarities = pair_similarities(embedding_model, pairs[benchmark_file])
+            results[(benchmark_file, embedding_file)] = similarity_accuracy(similarities, thresholds)
+            logger.info('{}, {}: {} of {} pairs found, accuracy: {}'.format(
+                benchmark_file, embedding_file, len(similarities), len(pairs[benchmark_file]),
+                results[(benchmark_file, embedding_file)]))
+
+    if result_file:
+        with open(result_file, 'w') as r_out:
+            r_out.write('{}\n'.format('\t'.join(['benchmark', 'embedding'] + map(str, thresholds))))
+            for benchmark_file in benchmark_files:
+                for embedding_file, _ in embedding_files:
+                    r_out.write('{}\n'.format('\t'.join(
+                        [benchmark_file, embedding_file] + map(str, results[(benchmark_file, embedding_file)]))))
+        logger.info('Pair similarity results saved at {}'.format(result_file))
+    return results
+
+
 def plot_pair_similarity_results(methods, results, output_figure):
     fig, ax = plt.subplots()
     line_colors = ['#e8814c', '#9cb2b3', '#e5cb80']
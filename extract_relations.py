@@ -1,7 +1,10 @@
 # -*- coding: utf8 -*-
 
 import os
+import time
 import codecs
+import heapq
+import socket
 import logging
 import logging.config
 import MySQLdb
@@ -16,7 +19,28 @@ from segtok.segmenter import split_multi
 from dependency_graph import DependencyGraph
 from word_unit_sequence import WordUnitSequence, Predicate
 from entity_linking import EntityLinker
+from work_queue import WorkQueue, iter_task_lines
+from packed_corpus import PackedCorpus
+from dedup import SentenceCache
+from parser_backend import get_parser, ReplayParser
+from metrics import metrics
 from utils import timeit
+from profiling import start_profiler
+
+
+def insert_relation_sql(sentence, relation, table_name='svo'):
+    sentence = sentence.replace('"', '')
+    return u"""
+        INSERT INTO {} (subject_head, subject_nn_head, subject, subject_el, predicate, predicate_canonical,
+                        object_head, object_nn_head, object, object_el, sentence)
+        VALUES ("{}", "{}", "{}", "{}", "{}", "{}", "{}", "{}", "{}", "{}", "{}");
+    """.format(
+        table_name,
+        relation.subject.head.lemma, relation.subject.nn_head.lemma, relation.subject.lemma, relation.subject_el,
+        relation.predicate.lemma, relation.predicate.canonical_form,
+        relation.object.head.lemma, relation.object.nn_head.lemma, relation.object.lemma, relation.object_el,
+        sentence
+    )
 
 
 class RelationExtractor(object):
@@ -121,21 +145,11 @@ class RelationExtractor(object):
         return self._relations
 
     def insert_relation_sql(self, relation, table_name='svo'):
-        sentence = self._sentence.replace('"', '')
-        return u"""
-            INSERT INTO {} (subject_head, subject_nn_head, subject, subject_el, predicate, predicate_canonical,
-                            object_head, object_nn_head, object, object_el, sentence)
-            VALUES ("{}", "{}", "{}", "{}", "{}", "{}", "{}", "{}", "{}", "{}", "{}");
-        """.format(
-            table_name,
-            relation.subject.head.lemma, relation.subject.nn_head.lemma, relation.subject.lemma, relation.subject_el,
-            relation.predicate.lemma, relation.predicate.canonical_form,
-            relation.object.head.lemma, relation.object.nn_head.lemma, relation.object.lemma, relation.object_el,
-            sentence
-        )
+        return insert_relation_sql(self._sentence, relation, table_name)
 
     def _print_expansion_debug_info(self, head_word, dep, added):
-        self.logger.debug(u'"{}" expanded with {}: "{}"'.format(head_word, dep, added))
+        # Called for every expansion step, the message is only formatted if DEBUG is enabled.
+        self.logger.debug(u'"%s" expanded with %s: "%s"', head_word, dep, added)
 
     def _get_dependents(self, dependency_relation, head, dependent=None):
         dependents = []
@@ -405,7 +419,8 @@ class RelationExtractor(object):
             query_arr = [query]
             for w in [wn for wn in context if not wn == query]:
                 query_arr.append(w)
-            return linker.link(query_arr)
+            with timeit('entity_linking'):
+                return linker.link(query_arr)
 
         linker = EntityLinker(self.logger) if self.entity_linking_flag else None
         dependencies = [self._dependencies['nsubj'], self._dependencies['nsubjpass']]
@@ -464,14 +479,7 @@ class RelationExtractor(object):
                                         self.relations.add(Relation(subject, predicate, object))
 
 
-@begin.subcommand
-def batch_extraction(parser_port, dataset, dataset_no, mysql_db):
-    with open('config/logging_config.yaml') as f:
-        logging.config.dictConfig(yaml.load(f))
-    logger = logging.getLogger('batch_relation_extraction')
-
-    parser_server = 'http://127.0.0.1:{}'.format(str(parser_port))
-
+def _connect_mysql(mysql_db):
     mysql_config = SafeConfigParser()
     mysql_config.read('config/mysql_config.ini')
     mysql_config = {
@@ -482,8 +490,65 @@ def batch_extraction(parser_port, dataset, dataset_no, mysql_db):
         'charset': mysql_config.get('MySQL', 'charset'),
         'use_unicode': True
     }
-    conn = MySQLdb.connect(**mysql_config)
+    return MySQLdb.connect(**mysql_config)
+
+
+def _extract_sentence(sent, parser_server, logger, source, sentence_cache=None):
+    """Extract relations from one sentence. Returns None if the extraction failed.
+       Sentences already in sentence_cache are not parsed again."""
+    logger.info(u'%s: %s', source, sent)
+    metrics.tick()
+    metrics.incr('sentences')
+    if sentence_cache is not None:
+        relations = sentence_cache.get(sent)
+        if relations is not None:
+            logger.info(u'Duplicate sentence, reusing %d relations', len(relations))
+            metrics.incr('duplicate_sentences')
+            return relations
+    t0 = time.time()
+    try:
+        extractor = RelationExtractor(sent, parser_server, logger, entity_linking_flag=False)
+        with timeit('extract_spo'):
+            extractor.extract_spo()
+    except:
+        logger.error(u'Failed to extract relations from: {}.'.format(sent), exc_info=True)
+        metrics.incr('failed_sentences')
+        return None
+    relations = list(extractor.relations)
+    metrics.incr('relations', len(relations))
+    if sentence_cache is not None:
+        sentence_cache.put(sent, relations, time.time() - t0)
+    return relations
+
+
+def _store_relations(sent, relations, conn, cur, logger):
+    for relation in relations:
+        logger.info(u'RELATION: %s', relation)
+        if conn:
+            try:
+                with timeit('db_flush'):
+                    cur.execute(insert_relation_sql(sent, relation))
+                    conn.commit()
+            except MySQLdb.Error as e:
+                metrics.incr('db_errors')
+                try:
+                    logger.error(u'MySQL Error [{}]: {}'.format(e.args[0], e.args[1]), exc_info=True)
+                except IndexError:
+                    logger.error(u'MySQL Error: {}'.format(str(e)), exc_info=True)
+
+
+@begin.subcommand
+def batch_extraction(parser_port, dataset, dataset_no, mysql_db, parser_record=None, parser_replay=None,
+                     dedup_cache_size=50000, quiet=False):
+    with open('config/logging_config.yaml') as f:
+        logging.config.dictConfig(yaml.load(f))
+    logger = logging.getLogger('quiet_relation_extraction' if quiet else 'batch_relation_extraction')
+
+    parser_server = get_parser('http://127.0.0.1:{}'.format(str(parser_port)), parser_record, parser_replay)
+
+    conn = _connect_mysql(mysql_db)
     cur = conn.cursor()
+    sentence_cache = SentenceCache(dedup_cache_size, logger) if int(dedup_cache_size) else None
 
     data_subdir = 'preprocessed_organized'
     data_dir = 'data/{}/{}/{}'.format(dataset, data_subdir, dataset_no)
@@ -492,36 +557,13 @@ def batch_extraction(parser_port, dataset, dataset_no, mysql_db):
             if fn.endswith('.txt'):
                 data_file = os.path.join(root, fn)
                 f_in = codecs.open(data_file, encoding='utf-8')
-                # output_filename = os.path.join(root, fn).replace('/preprocessed/', '/extractions/')
-                # f_out = codecs.open(output_filename, 'w', encoding='utf-8')
                 for line in f_in:
                     sent = line.strip()
                     if sent:
-                        logger.info(u'{}: {}'.format(data_file, sent))
-                        # f_out.write(u'{}\n'.format(sent))
-                        try:
-                            extractor = RelationExtractor(sent, parser_server, logger, entity_linking_flag=False)
-                            extractor.extract_spo()
-                        except:
-                            logger.error(u'Failed to extract relations from: {}.'.format(sent), exc_info=True)
-                        else:
-                            for relation in extractor.relations:
-                                logger.info(u'RELATION: {}'.format(relation))
-                                # f_out.write(u'{} [{}]\n'.format(relation, relation.canonical_form))
-                                if mysql_db:
-                                    try:
-                                        cur.execute(extractor.insert_relation_sql(relation))
-                                        conn.commit()
-                                    except MySQLdb.Error as e:
-                                        try:
-                                            logger.error(u'MySQL Error [{}]: {}'.format(e.args[0], e.args[1]),
-                                                         exc_info=True)
-                                        except IndexError:
-                                            logger.error(u'MySQL Error: {}'.format(str(e)), exc_info=True)
-                            # f_out.write('\n')
-
+                        relations = _extract_sentence(sent, parser_server, logger, data_file, sentence_cache)
+                        if relations is not None:
+                            _store_relations(sent, relations, conn if mysql_db else None, cur, logger)
                 f_in.close()
-                # f_out.close()
 
                 done_subdir = 'extraction_done'
                 done_filename = data_file.replace('/{}/'.format(data_subdir), '/{}/'.format(done_subdir))
@@ -529,17 +571,127 @@ def batch_extraction(parser_port, dataset, dataset_no, mysql_db):
                     os.makedirs(os.path.dirname(done_filename))
                 os.rename(data_file, done_filename)
 
+    if sentence_cache is not None:
+        sentence_cache.report()
+    parser_server.close()
+    cur.close()
+    conn.close()
+
+
+@begin.subcommand
+def packed_extraction(parser_port, dataset, mysql_db, worker_no=0, worker_n=1, parser_record=None,
+                      parser_replay=None, dedup_cache_size=50000, quiet=False):
+    """Extract relations from the packed corpus of a dataset (see preprocess.py pack).
+       Worker worker_no of worker_n takes every worker_n-th document. Each finished document is checkpointed in the
+       status log of the corpus, and skipped when the extraction is restarted."""
+    with open('config/logging_config.yaml') as f:
+        logging.config.dictConfig(yaml.load(f))
+    logger = logging.getLogger('quiet_relation_extraction' if quiet else 'batch_relation_extraction')
+
+    parser_server = get_parser('http://127.0.0.1:{}'.format(str(parser_port)), parser_record, parser_replay)
+
+    conn = _connect_mysql(mysql_db)
+    cur = conn.cursor()
+    sentence_cache = SentenceCache(dedup_cache_size, logger) if int(dedup_cache_size) else None
+
+    worker_no, worker_n = int(worker_no), int(worker_n)
+    corpus = PackedCorpus('data/{}/preprocessed_packed'.format(dataset))
+    # The partition is taken over all documents, so it does not change when the extraction is restarted.
+    doc_ids = [doc_id for i, doc_id in enumerate(corpus.doc_ids()) if i % worker_n == worker_no and
+               not corpus.status(doc_id) == 'extracted']
+    logger.info('{} documents to extract'.format(len(doc_ids)))
+    for doc_id, text in corpus.documents(doc_ids=doc_ids):
+        # Split on line feeds only, as iter_task_lines (splitlines() also splits on form feeds, U+2028, ...).
+        for line in text.split(u'\n'):
+            sent = line.strip()
+            if sent:
+                relations = _extract_sentence(sent, parser_server, logger, doc_id, sentence_cache)
+                if relations is not None:
+                    _store_relations(sent, relations, conn if mysql_db else None, cur, logger)
+        corpus.mark(doc_id, 'extracted')
+    corpus.close()
+
+    if sentence_cache is not None:
+        sentence_cache.report()
+    parser_server.close()
+    cur.close()
+    conn.close()
+
+
+@begin.subcommand
+def enqueue_extraction(dataset, queue_db, chunk_size=1000):
+    """Fill the shared work queue with sentence ranges of the preprocessed files."""
+    with open('config/logging_config.yaml') as f:
+        logging.config.dictConfig(yaml.load(f))
+    logger = logging.getLogger('batch_relation_extraction')
+
+    data_dir = 'data/{}/preprocessed'.format(dataset)
+    queue = WorkQueue(queue_db, logger=logger)
+    task_n = queue.add_dir(data_dir, chunk_size)
+    logger.info('{} tasks from {} added to {}'.format(task_n, data_dir, queue_db))
+    logger.info('Queue status: {}'.format(queue.stats()))
+    queue.close()
+
+
+@begin.subcommand
+def queue_extraction(parser_port, queue_db, mysql_db, worker_id=None, lease_seconds=600,
+                     parser_record=None, parser_replay=None, dedup_cache_size=50000, quiet=False):
+    """Claim sentence ranges from the shared work queue until it is drained.
+       Any number of workers can run against the same queue_db."""
+    with open('config/logging_config.yaml') as f:
+        logging.config.dictConfig(yaml.load(f))
+    logger = logging.getLogger('quiet_relation_extraction' if quiet else 'batch_relation_extraction')
+
+    parser_server = get_parser('http://127.0.0.1:{}'.format(str(parser_port)), parser_record, parser_replay)
+    worker_id = worker_id if worker_id else '{}:{}'.format(socket.gethostname(), os.getpid())
+    # Renew the lease well before it expires.
+    heartbeat_interval = int(lease_seconds) / 3.0
+
+    conn = _connect_mysql(mysql_db)
+    cur = conn.cursor()
+    sentence_cache = SentenceCache(dedup_cache_size, logger) if int(dedup_cache_size) else None
+    queue = WorkQueue(queue_db, lease_seconds, logger)
+
+    task = queue.claim(worker_id)
+    while task:
+        logger.info(u'{} claimed task {}: {} [{}, {})'.format(
+            worker_id, task.id, task.path, task.start_line, task.end_line))
+        last_heartbeat = time.time()
+        lease_lost = False
+        for line in iter_task_lines(task):
+            sent = line.strip()
+            if sent:
+                relations = _extract_sentence(sent, parser_server, logger, task.path, sentence_cache)
+                if relations is not None:
+                    _store_relations(sent, relations, conn if mysql_db else None, cur, logger)
+            if time.time() - last_heartbeat > heartbeat_interval:
+                if not queue.heartbeat(task.id, worker_id):
+                    lease_lost = True
+                    break
+                last_heartbeat = time.time()
+
+        if lease_lost:
+            logger.warning(u'{} lost the lease of task {}, abandoning it'.format(worker_id, task.id))
+        elif not queue.complete(task.id, worker_id):
+            logger.warning(u'{} finished task {} after its lease expired'.format(worker_id, task.id))
+        task = queue.claim(worker_id)
+
+    logger.info('Queue drained: {}'.format(queue.stats()))
+    if sentence_cache is not None:
+        sentence_cache.report()
+    queue.close()
+    parser_server.close()
     cur.close()
     conn.close()
 
 
 @begin.subcommand
-def single_extraction(sentences):
+def single_extraction(sentences, parser_record=None, parser_replay=None):
     with open('config/logging_config.yaml') as f:
         logging.config.dictConfig(yaml.load(f))
     logger = logging.getLogger('single_relation_extraction')
 
-    parser_server = 'http://127.0.0.1:8084'
+    parser_server = get_parser('http://127.0.0.1:8084', parser_record, parser_replay)
 
     for sent in split_multi(sentences):
         sent = sent.strip()
@@ -562,32 +714,153 @@ def single_extraction(sentences):
                         logger.debug(u'OBJECT EL: {}'.format(relation.object_el))
                     logger.debug(u'RELATION LEMMA: {}'.format(relation.lemma))
                     logger.debug(u'RELATION CANONICAL: {}'.format(relation.canonical_form))
+    parser_server.close()
 
 
 @begin.subcommand
-def organize_data_folder(dataset, sub_folder_no):
+def benchmark_extraction(parser_replay, repeat=1, log_level=None):
+    """Measure the extraction throughput over the sentences of a parser record file, no parser server needed.
+       --log-level DEBUG measures the cost of the debug logging of the extraction."""
+    with open('config/logging_config.yaml') as f:
+        logging.config.dictConfig(yaml.load(f))
+    logger = logging.getLogger('benchmark_extraction')
+    if log_level:
+        logger.setLevel(log_level)
+
+    parser = ReplayParser(parser_replay)
+    sentences = parser.sentences
+    logger.info('{} recorded sentences loaded from {}'.format(len(sentences), parser_replay))
+
+    sentence_n, relation_n, failure_n = 0, 0, 0
+    t0 = time.time()
+    for _ in xrange(int(repeat)):
+        for sent in sentences:
+            sentence_n += 1
+            try:
+                extractor = RelationExtractor(sent, parser, logger, entity_linking_flag=False)
+                extractor.extract_spo()
+            except:
+                failure_n += 1
+                logger.error(u'Failed to extract relations from: {}.'.format(sent), exc_info=True)
+            else:
+                relation_n += len(extractor.relations)
+    elapsed_time = time.time() - t0
+    logger.info('{} sentences, {} relations, {} failures in {:.2f}s ({:.1f} sentences/s)'.format(
+        sentence_n, relation_n, failure_n, elapsed_time, sentence_n / elapsed_time if elapsed_time else 0.0))
+
+
+def _count_lines(filename):
+    count = 0
+    with open(filename, 'rb') as f:
+        for line in f:
+            if line.strip():
+                count += 1
+    return count
+
+
+def _read_manifest(manifest_file):
+    """Shard stats of an earlier organize_data_folder run, by shard number. The sentences of a shard are None when
+       they were not counted (balanced by bytes)."""
+    shard_stats = {}
+    with codecs.open(manifest_file, encoding='utf-8') as f:
+        next(f)
+        for line in f:
+            parts = line.rstrip(u'\n').split(u'\t')
+            if len(parts) == 4:
+                shard_stats[int(parts[0])] = {'files': int(parts[1]), 'bytes': int(parts[2]),
+                                              'sentences': int(parts[3]) if parts[3] else None}
+    return shard_stats
+
+
+def _measure_shard(shard_dir, count_sentences):
+    stats = {'files': 0, 'bytes': 0, 'sentences': 0 if count_sentences else None}
+    for root, _, files in os.walk(shard_dir):
+        for fn in files:
+            if fn.endswith('.txt'):
+                filename = os.path.join(root, fn)
+                stats['files'] += 1
+                stats['bytes'] += os.path.getsize(filename)
+                if count_sentences:
+                    stats['sentences'] += _count_lines(filename)
+    return stats
+
+
+@begin.subcommand
+def organize_data_folder(dataset, sub_folder_no, balance_by='bytes'):
     with open('config/logging_config.yaml') as f:
         logging.config.dictConfig(yaml.load(f))
     logger = logging.getLogger('single_relation_extraction')
 
+    if balance_by not in ('bytes', 'sentences'):
+        raise ValueError('balance_by must be either "bytes" or "sentences".')
+    sub_folder_no = int(sub_folder_no)
+    # Lines are only counted when the shards are balanced by them, otherwise every file would be read for nothing.
+    count_sentences = balance_by == 'sentences'
+
     data_dir = 'data/{}/preprocessed'.format(dataset)
-    file_no = 0
+    organized_dir = 'data/{}/preprocessed_organized'.format(dataset)
+    manifest_file = os.path.join(organized_dir, 'manifest.tsv')
+
+    # On a rerun, the new files are added to the shards of the earlier runs, starting from their manifest.
+    shard_stats = _read_manifest(manifest_file) if os.path.exists(manifest_file) else {}
+    for shard_no in xrange(sub_folder_no):
+        stats = shard_stats.get(shard_no)
+        if stats is None or (count_sentences and stats['sentences'] is None):
+            # Not in the manifest (or without its sentences), measure what is already in the shard.
+            shard_stats[shard_no] = _measure_shard(os.path.join(organized_dir, str(shard_no)), count_sentences)
+
+    # Measure every file first, so the shards can be balanced by the actual work instead of the file count.
+    data_files = []
     for root, _, files in os.walk(data_dir):
         for fn in files:
             if fn.endswith('.txt'):
                 filename = os.path.join(root, fn)
-                new_filename = filename.replace(
-                    '/preprocessed/', '/preprocessed_organized/{}/'.format(str(file_no % int(sub_folder_no))))
-                logger.info('{} -> {}'.format(filename, new_filename))
-                if not os.path.exists(os.path.dirname(new_filename)):
-                    os.makedirs(os.path.dirname(new_filename))
-                os.rename(filename, new_filename)
-                file_no += 1
+                data_files.append((filename, os.path.getsize(filename),
+                                   _count_lines(filename) if count_sentences else None))
+    logger.info('{} files found in {}'.format(len(data_files), data_dir))
+
+    # Greedy bin packing: place the largest remaining file into the currently lightest shard.
+    weight_index = 1 if balance_by == 'bytes' else 2
+    data_files.sort(key=lambda x: x[weight_index], reverse=True)
+    shards = [(shard_stats[shard_no][balance_by], shard_no) for shard_no in xrange(sub_folder_no)]
+    heapq.heapify(shards)
+    for data_file in data_files:
+        filename, size, sentence_n = data_file
+        load, shard_no = heapq.heappop(shards)
+        new_filename = filename.replace('/preprocessed/', '/preprocessed_organized/{}/'.format(str(shard_no)))
+        logger.info('{} -> {}'.format(filename, new_filename))
+        if not os.path.exists(os.path.dirname(new_filename)):
+            os.makedirs(os.path.dirname(new_filename))
+        os.rename(filename, new_filename)
+        stats = shard_stats[shard_no]
+        stats['files'] += 1
+        stats['bytes'] += size
+        if stats['sentences'] is not None and sentence_n is not None:
+            stats['sentences'] += sentence_n
+        else:
+            stats['sentences'] = None
+        heapq.heappush(shards, (load + data_file[weight_index], shard_no))
+
+    # Write the expected work per shard, so batch_extraction instances can be planned accordingly.
+    if not os.path.exists(organized_dir):
+        os.makedirs(organized_dir)
+    with codecs.open(manifest_file, 'w', encoding='utf-8') as f_out:
+        f_out.write(u'shard\tfiles\tbytes\tsentences\n')
+        for shard_no in sorted(shard_stats):
+            stats = shard_stats[shard_no]
+            sentences = u'' if stats['sentences'] is None else stats['sentences']
+            f_out.write(u'{}\t{}\t{}\t{}\n'.format(shard_no, stats['files'], stats['bytes'], sentences))
+            logger.info('shard {}: {} files, {} bytes, {} sentences'.format(
+                shard_no, stats['files'], stats['bytes'], 'unknown' if sentences == u'' else sentences))
+    logger.info('Shard manifest saved at {}'.format(manifest_file))
 
 
 @begin.start
-def main():
-    pass
+def main(metrics_file=None, metrics_interval=60, profile=None, profile_seconds=0, profile_mode='cprofile'):
+    if metrics_file:
+        metrics.enable(metrics_file, float(metrics_interval))
+    if profile:
+        start_profiler(profile, float(profile_seconds), profile_mode)
 
 if begin.start():
     pass
@@ -11,6 +11,7 @@ from nltk import pos_tag
 from nltk.tokenize import word_tokenize
 from nltk.stem import WordNetLemmatizer
 from segtok.segmenter import split_multi
+from profiling import start_profiler
 
 
 class VerbExtractor(object):
@@ -191,5 +192,6 @@ def test():
 
 @begin.start
 @begin.logging
-def run():
-    pass
+def run(profile=None, profile_seconds=0, profile_mode='cprofile'):
+    if profile:
+        start_profiler(profile, float(profile_seconds), profile_mode)
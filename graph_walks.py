@@ -0,0 +1,282 @@
+# -*- coding: utf8 -*-
+
+import os
+import array
+import codecs
+import logging
+import logging.config
+import multiprocessing
+import yaml
+import begin
+
+import numpy as np
+
+from time import time
+from collections import deque
+from gensim.models import Word2Vec
+from profiling import start_profiler
+
+
+class KBGraph(object):
+    """The weighted graph of an edge file written by construct_kb_graph.save_graph_to_file, in compressed sparse row
+       arrays: the neighbours of vertex v are neighbours[offsets[v]:offsets[v + 1]] (sorted), with their weights.
+       Every neighbour list has an alias table, so sampling a weighted neighbour is O(1).
+       Memory is a few numpy arrays of the edge count, no Python object per edge."""
+
+    def __init__(self, labels, offsets, neighbours, weights):
+        self.labels = labels
+        self.offsets = offsets
+        self.neighbours = neighbours
+        self.weights = weights
+        self.alias_prob, self.alias_index = _alias_tables(offsets, weights)
+        self._edge_keys = None
+
+    @property
+    def vertex_n(self):
+        return len(self.labels)
+
+    @property
+    def edge_n(self):
+        return len(self.neighbours)
+
+    @classmethod
+    def from_edge_file(cls, edge_file):
+        """Read an edge file of `vertex\tneighbour\tweight` lines. Duplicate edges are merged, their weights summed."""
+        vertex_ids = {}
+        sources, targets, weights = array.array('i'), array.array('i'), array.array('d')
+        with open(edge_file, 'rb') as f:
+            for line in f:
+                parts = line.rstrip('\n').split('\t')
+                if len(parts) < 3:
+                    continue
+                sources.append(vertex_ids.setdefault(parts[0], len(vertex_ids)))
+                targets.append(vertex_ids.setdefault(parts[1], len(vertex_ids)))
+                weights.append(float(parts[2]))
+        labels = [None] * len(vertex_ids)
+        for label, i in vertex_ids.iteritems():
+            labels[i] = label.decode('utf-8')
+        del vertex_ids
+
+        vertex_n = len(labels)
+        keys = np.frombuffer(sources, dtype=np.int32).astype(np.int64) * vertex_n
+        keys += np.frombuffer(targets, dtype=np.int32)
+        weights = np.frombuffer(weights, dtype=np.float64)
+        order = np.argsort(keys, kind='mergesort')
+        keys, weights = keys[order], weights[order]
+        del order, sources, targets
+
+        if len(keys):
+            starts = np.flatnonzero(np.concatenate([[True], keys[1:] != keys[:-1]]))
+            keys, weights = keys[starts], np.add.reduceat(weights, starts)
+        offsets = np.searchsorted(keys // vertex_n, np.arange(vertex_n + 1))
+        return cls(labels, offsets, (keys % vertex_n).astype(np.int32), weights.astype(np.float32))
+
+    def edge_keys(self):
+        """Sorted source * vertex_n + target keys of the edges, for the edge lookups of second order walks."""
+        if self._edge_keys is None:
+            sources = np.repeat(np.arange(self.vertex_n, dtype=np.int64), np.diff(self.offsets))
+            self._edge_keys = sources * self.vertex_n + self.neighbours
+        return self._edge_keys
+
+    def has_edges(self, sources, targets):
+        keys = self.edge_keys()
+        queries = sources.astype(np.int64) * self.vertex_n + targets
+        positions = np.minimum(np.searchsorted(keys, queries), len(keys) - 1)
+        return keys[positions] == queries
+
+    def sample_neighbours(self, vertices, rng):
+        """One weighted neighbour of each vertex, the vertices must have neighbours."""
+        starts = self.offsets[vertices]
+        degrees = self.offsets[vertices + 1] - starts
+        edges = starts + (rng.random_sample(len(vertices)) * degrees).astype(np.int64)
+        alias = rng.random_sample(len(vertices)) >= self.alias_prob[edges]
+        edges[alias] = starts[alias] + self.alias_index[edges[alias]]
+        return self.neighbours[edges]
+
+
+def _alias_tables(offsets, weights):
+    """Alias tables (Vose) of all the neighbour lists, as two edge arrays: the probability of keeping the sampled
+       slot, and the slot (relative to the list start) to take otherwise."""
+    prob = np.ones(len(weights), dtype=np.float32)
+    alias_index = np.zeros(len(weights), dtype=np.int32)
+    if not len(weights):
+        return prob, alias_index
+    degrees = np.diff(offsets)
+    nonempty = np.flatnonzero(degrees)
+    # Lists of a single neighbour or of equal weights are sampled uniformly, only the others need a table.
+    low = np.minimum.reduceat(weights, offsets[nonempty])
+    high = np.maximum.reduceat(weights, offsets[nonempty])
+    for v in nonempty[low < high]:
+        start, end = offsets[v], offsets[v + 1]
+        scaled = weights[start:end] * ((end - start) / weights[start:end].sum(dtype=np.float64))
+        small = list(np.flatnonzero(scaled < 1.0))
+        large = list(np.flatnonzero(scaled >= 1.0))
+        scaled = scaled.tolist()
+        while small and large:
+            s, l = small.pop(), large[-1]
+            prob[start + s] = scaled[s]
+            alias_index[start + s] = l
+            scaled[l] -= 1.0 - scaled[s]
+            if scaled[l] < 1.0:
+                small.append(large.pop())
+        # What is left is 1 up to rounding errors.
+    return prob, alias_index
+
+
+def random_walks(graph, start_vertices, walk_length, p=1.0, q=1.0, rng=None):
+    """Weighted random walks of walk_length vertices from each start vertex, all advanced one step at a time
+       with array operations. Returns a len(start_vertices) x walk_length array, padded with -1 after a vertex
+       without neighbours.
+       With p = q = 1 (the default) these are first order (DeepWalk) walks, the next vertex only depends on the
+       edge weights. Otherwise the next vertex is biased as in node2vec: the weight of the edge back to the previous
+       vertex is divided by p, and the weight of the edges to vertices not adjacent to the previous vertex by q. The
+       biased step is sampled by rejection from the first order one, no second order table is built."""
+    rng = rng if rng is not None else np.random.RandomState()
+    p, q = float(p), float(q)
+    walks = np.full((len(start_vertices), walk_length), -1, dtype=np.int32)
+    walks[:, 0] = start_vertices
+    active = np.arange(len(start_vertices))
+    biased = not (p == 1.0 and q == 1.0)
+    max_bias = max(1.0 / p, 1.0, 1.0 / q)
+    for step in range(1, walk_length):
+        current = walks[active, step - 1]
+        has_neighbours = graph.offsets[current + 1] > graph.offsets[current]
+        active, current = active[has_neighbours], current[has_neighbours]
+        if not len(active):
+            break
+        if not biased or step == 1:
+            walks[active, step] = graph.sample_neighbours(current, rng)
+            continue
+        pending = np.arange(len(active))
+        while len(pending):
+            previous = walks[active[pending], step - 2]
+            candidates = graph.sample_neighbours(current[pending], rng)
+            bias = np.where(candidates == previous, 1.0 / p,
+                            np.where(graph.has_edges(previous, candidates), 1.0, 1.0 / q))
+            accepted = rng.random_sample(len(pending)) * max_bias < bias
+            walks[active[pending[accepted]], step] = candidates[accepted]
+            pending = pending[~accepted]
+    return walks
+
+
+# Set before the pool is forked, so the workers share the graph instead of receiving a pickled copy.
+_shared = None
+
+
+def _walk_batch(args):
+    start_vertices, seed = args
+    graph, walk_length, p, q = _shared
+    return random_walks(graph, start_vertices, walk_length, p, q, np.random.RandomState(seed))
+
+
+class RandomWalks(object):
+    """The walks as a corpus of label sentences, walk_n walks from every vertex (in a new random order every round).
+       The walks are generated in batches of batch_size by a pool of processes, at most 2 batches per process ahead
+       of the consumer, so memory does not depend on the number of walks. Every iteration yields the same walks, as
+       the batches are seeded from seed, so the corpus can be iterated by Word2Vec once per epoch."""
+
+    def __init__(self, graph, walk_n=10, walk_length=40, p=1.0, q=1.0, processes=1, batch_size=10000, seed=0):
+        self.graph = graph
+        self.walk_n = int(walk_n)
+        self.walk_length = int(walk_length)
+        self.p = float(p)
+        self.q = float(q)
+        self.processes = int(processes)
+        self.batch_size = int(batch_size)
+        self.seed = int(seed)
+        if not (self.p == 1.0 and self.q == 1.0):
+            # Built before the fork, so the workers share it.
+            graph.edge_keys()
+
+    def _batches(self):
+        batch_no = 0
+        for round_no in range(self.walk_n):
+            order = np.random.RandomState([self.seed, 0, round_no]).permutation(self.graph.vertex_n).astype(np.int32)
+            for start in xrange(0, len(order), self.batch_size):
+                yield order[start:start + self.batch_size], [self.seed, 1, batch_no]
+                batch_no += 1
+
+    def _walk_arrays(self):
+        global _shared
+        _shared = (self.graph, self.walk_length, self.p, self.q)
+        if self.processes <= 1:
+            for batch in self._batches():
+                yield _walk_batch(batch)
+            return
+        pool = multiprocessing.Pool(self.processes)
+        try:
+            pending = deque()
+            for batch in self._batches():
+                pending.append(pool.apply_async(_walk_batch, (batch, )))
+                if len(pending) >= 2 * self.processes:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def __iter__(self):
+        labels = self.graph.labels
+        for walks in self._walk_arrays():
+            for walk in walks.tolist():
+                yield [labels[v] for v in walk if v >= 0]
+
+
+def write_walks(walks, walk_file, logger=None):
+    """Write the walks to walk_file, one walk per line (the LineSentence format), for corpus_file training."""
+    logger = logger if logger else logging.getLogger()
+    t0 = time()
+    tmp_file = walk_file + '.tmp'
+    walk_n = 0
+    with codecs.open(tmp_file, 'w', encoding='utf-8') as f:
+        for walk in walks:
+            f.write(u'{}\n'.format(u' '.join(walk)))
+            walk_n += 1
+    os.rename(tmp_file, walk_file)
+    logger.info('{} walks written to {} in {:.1f}s'.format(walk_n, walk_file, time() - t0))
+
+
+@begin.subcommand
+def train(dataset, graph_file, model_file, walk_n=10, walk_length=40, p=1.0, q=1.0, processes=1, workers=16,
+          size=200, window=5, seed=0, walk_file=None):
+    """Train vertex embeddings (e.g. scikb_directed) on random walks over an edge file of construct_kb_graph, both
+       in data/<dataset>/embeddings. The walks are streamed into Word2Vec, or with --walk-file written to that file
+       first (unless it exists) and read by gensim's corpus_file training, which keeps all the workers busy."""
+    with open('config/logging_config.yaml') as f:
+        logging.config.dictConfig(yaml.load(f))
+    logger = logging.getLogger('graph_walks')
+
+    t0 = time()
+    graph = KBGraph.from_edge_file('data/{}/embeddings/{}'.format(dataset, graph_file))
+    logger.info('{} vertices and {} edges loaded in {:.1f}s'.format(graph.vertex_n, graph.edge_n, time() - t0))
+    walks = RandomWalks(graph, walk_n, walk_length, p, q, int(processes), seed=int(seed))
+
+    # Every vertex starts walk_n walks, so min_count=1 keeps them all.
+    params = dict(size=int(size), window=int(window), workers=int(workers), sg=1, hs=0, negative=5, min_count=1,
+                  seed=int(seed))
+    if walk_file:
+        walk_file = 'data/{}/embeddings/{}'.format(dataset, walk_file)
+        if os.path.exists(walk_file):
+            logger.info('Training from the existing walk file {}'.format(walk_file))
+        else:
+            write_walks(walks, walk_file, logger)
+        model = Word2Vec(corpus_file=walk_file, **params)
+    else:
+        model = Word2Vec(walks, **params)
+    model_file = 'data/{}/embeddings/{}'.format(dataset, model_file)
+    if hasattr(model, 'wv'):
+        model.wv.save_word2vec_format(model_file, binary=True)
+    else:
+        model.save_word2vec_format(model_file, binary=True)
+    logger.info('Model saved at {} after {:.1f}s'.format(model_file, time() - t0))
+
+
+@begin.start
+def main(profile=None, profile_seconds=0, profile_mode='cprofile'):
+    if profile:
+        start_profiler(profile, float(profile_seconds), profile_mode)
+
+if begin.start():
+    pass
@@ -0,0 +1,168 @@
+# -*- coding: utf8 -*-
+
+import os
+import json
+import math
+import time
+import atexit
+import logging
+
+
+class Histogram(object):
+    """Latency histogram with power-of-two buckets, observing a value is a frexp and a dict update.
+       Percentiles are reported as the upper bound of their bucket."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._buckets = {}
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        exponent = math.frexp(value)[1]
+        self._buckets[exponent] = self._buckets.get(exponent, 0) + 1
+
+    def percentile(self, p):
+        if not self.count:
+            return 0.0
+        rank = p / 100.0 * self.count
+        seen = 0
+        for exponent in sorted(self._buckets):
+            seen += self._buckets[exponent]
+            if seen >= rank:
+                return min(math.ldexp(1.0, exponent), self.max)
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count if self.count else 0.0,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'max': self.max,
+        }
+
+
+class _Timer(object):
+    __slots__ = ('_histogram', '_t0')
+
+    def __init__(self, histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._t0 = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._histogram.observe(time.time() - self._t0)
+        return False
+
+
+class _NullTimer(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_null_timer = _NullTimer()
+
+
+class Metrics(object):
+    """Counters and latency histograms of the pipeline stages.
+       Disabled by default, a disabled hook is one attribute check (or a shared no-op context manager for timer()).
+       Once enabled, a JSON snapshot is appended to the snapshot file every interval seconds (checked by tick()),
+       and a final snapshot and a summary are written at exit."""
+
+    def __init__(self, logger=None):
+        self.logger = logger if logger else logging.getLogger()
+        self.enabled = False
+        self._counters = {}
+        self._histograms = {}
+        self._snapshot_file = None
+        self._interval = 60.0
+        self._next_snapshot = 0.0
+        self._start_time = time.time()
+
+    def enable(self, snapshot_file=None, interval=60):
+        if not self.enabled:
+            atexit.register(self.close)
+        self.enabled = True
+        self._snapshot_file = snapshot_file
+        self._interval = float(interval)
+        self._start_time = time.time()
+        self._next_snapshot = self._start_time + self._interval
+
+    def incr(self, name, n=1):
+        if self.enabled:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def observe(self, name, value):
+        if self.enabled:
+            self._histogram(name).observe(value)
+
+    def timer(self, name):
+        """Context manager adding the time spent in its block to the histogram name."""
+        if not self.enabled:
+            return _null_timer
+        return _Timer(self._histogram(name))
+
+    def _histogram(self, name):
+        histogram = self._histograms.get(name)
+        if histogram is None:
+            histogram = self._histograms[name] = Histogram()
+        return histogram
+
+    def tick(self):
+        """Write a snapshot if the interval has passed. Cheap enough to call once per sentence."""
+        if self.enabled and self._snapshot_file and time.time() >= self._next_snapshot:
+            self.write_snapshot()
+
+    def snapshot(self):
+        now = time.time()
+        return {
+            'time': now,
+            'elapsed': now - self._start_time,
+            'pid': os.getpid(),
+            'counters': dict(self._counters),
+            'histograms': dict((name, histogram.snapshot()) for name, histogram in self._histograms.items()),
+        }
+
+    def write_snapshot(self, final=False):
+        self._next_snapshot = time.time() + self._interval
+        snapshot = self.snapshot()
+        snapshot['final'] = final
+        with open(self._snapshot_file, 'a') as f:
+            f.write('{}\n'.format(json.dumps(snapshot, sort_keys=True)))
+
+    def summary(self):
+        snapshot = self.snapshot()
+        lines = ['Metrics after {:.1f}s'.format(snapshot['elapsed'])]
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append('{}: {}'.format(name, value))
+        for name, h in sorted(snapshot['histograms'].items()):
+            lines.append('{}: n={} total={:.3f}s mean={:.2f}ms p50<={:.2f}ms p90<={:.2f}ms p99<={:.2f}ms '
+                         'max={:.2f}ms'.format(name, h['count'], h['total'], h['mean'] * 1000, h['p50'] * 1000,
+                                               h['p90'] * 1000, h['p99'] * 1000, h['max'] * 1000))
+        return lines
+
+    def close(self):
+        if not self.enabled:
+            return
+        if self._snapshot_file:
+            self.write_snapshot(final=True)
+        for line in self.summary():
+            self.logger.info(line)
+        self.enabled = False
+
+
+# The metrics of this process, enabled by the --metrics-file option of the entry points.
+metrics = Metrics()
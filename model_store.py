@@ -0,0 +1,102 @@
+# -*- coding: utf8 -*-
+
+import os
+import codecs
+import logging
+
+import numpy as np
+
+
+class ModelStore(object):
+    """Read-only word vectors converted from a word2vec model file (see convert()).
+       The vectors are memory-mapped, so loading is near-instant and processes loading the same store share one copy
+       of the vectors through the page cache. Supports the lookups used here: `word in store`, `store[word]`,
+       and similarity()."""
+
+    def __init__(self, model_file):
+        self.vectors = np.load(model_file + '.vectors.npy', mmap_mode='r')
+        with codecs.open(model_file + '.vocab.txt', encoding='utf-8') as f:
+            self.words = [line.rstrip(u'\n') for line in f]
+        self.vocab = dict((word, i) for i, word in enumerate(self.words))
+
+    def __contains__(self, word):
+        return word in self.vocab
+
+    def __getitem__(self, word):
+        return self.vectors[self.vocab[word]]
+
+    def __len__(self):
+        return len(self.words)
+
+    def indices(self, words):
+        """Vocabulary indices of the words, -1 for the words not in the vocabulary."""
+        return np.fromiter((self.vocab.get(word, -1) for word in words), dtype=np.int64, count=len(words))
+
+    def similarity(self, word_1, word_2):
+        """Cosine similarity, as gensim's similarity()."""
+        v_1, v_2 = self[word_1], self[word_2]
+        return float(np.dot(v_1, v_2) / (np.linalg.norm(v_1) * np.linalg.norm(v_2)))
+
+
+def _read_word(f):
+    chars = []
+    while True:
+        c = f.read(1)
+        if c == ' ' or not c:
+            break
+        # Skip the newline gensim writes after each binary vector.
+        if not c == '\n':
+            chars.append(c)
+    return ''.join(chars)
+
+
+def convert(model_file, binary=True, logger=None):
+    """Convert a word2vec model file (binary or text format) into <model_file>.vectors.npy and
+       <model_file>.vocab.txt. The vectors are written to a memory-mapped array, never held in memory."""
+    logger = logger if logger else logging.getLogger()
+    # Per process, so concurrent conversions of the same model do not write into each other's files.
+    tmp_prefix = '{}.{}.tmp'.format(model_file, os.getpid())
+    logger.info('Converting {} into a model store...'.format(model_file))
+    with open(model_file, 'rb') as f:
+        word_n, dim = map(int, f.readline().split())
+        vectors = np.lib.format.open_memmap(tmp_prefix + '.vectors.npy', mode='w+', dtype=np.float32,
+                                            shape=(word_n, dim))
+        vector_size = np.dtype(np.float32).itemsize * dim
+        with codecs.open(tmp_prefix + '.vocab.txt', 'w', encoding='utf-8') as vocab_out:
+            for i in xrange(word_n):
+                if binary:
+                    word = _read_word(f)
+                    vectors[i] = np.frombuffer(f.read(vector_size), dtype=np.float32)
+                else:
+                    parts = f.readline().rstrip().split(' ')
+                    word = parts[0]
+                    vectors[i] = np.array(parts[1:], dtype=np.float32)
+                vocab_out.write(u'{}\n'.format(word.decode('utf-8')))
+        vectors.flush()
+        del vectors
+    # The store only appears once complete (the renames are atomic, the temporary files are in the same directory).
+    os.rename(tmp_prefix + '.vocab.txt', model_file + '.vocab.txt')
+    os.rename(tmp_prefix + '.vectors.npy', model_file + '.vectors.npy')
+    logger.info('{} vectors of dimension {} saved at {}.vectors.npy'.format(word_n, dim, model_file))
+
+
+def _is_stale(model_file):
+    for path in [model_file + '.vectors.npy', model_file + '.vocab.txt']:
+        if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(model_file):
+            return True
+    return False
+
+
+# Stores already loaded by this process, by absolute model file path.
+_cache = {}
+
+
+def load(model_file, binary=True, logger=None):
+    """Load the store of a word2vec model file, converting the model first if there is no store yet
+       (or the model file is newer). A store is loaded once per process."""
+    key = os.path.abspath(model_file)
+    if key not in _cache:
+        if _is_stale(model_file):
+            convert(model_file, binary, logger)
+        _cache[key] = ModelStore(model_file)
+    return _cache[key]
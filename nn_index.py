@@ -0,0 +1,212 @@
+# -*- coding: utf8 -*-
+
+import os
+import codecs
+import logging
+import logging.config
+import yaml
+import begin
+
+import numpy as np
+
+from time import time
+from sklearn.cluster import MiniBatchKMeans
+
+
+def load_embedding_file(dataset, embedding_model_name, embedding_type):
+    """Embeddings and labels written by clustering.generate_embedding_file."""
+    prefix = 'data/{}/embeddings/{}_{}'.format(dataset, embedding_model_name, embedding_type)
+    with codecs.open(prefix + '_labels.txt', encoding='utf-8') as f:
+        labels = [line.strip() for line in f if line.strip()]
+    embeddings = np.load(prefix + '.npy')
+    if len(labels) != len(embeddings):
+        raise ValueError('{}_labels.txt has {} labels but {}.npy has {} embeddings.'.format(
+            prefix, len(labels), prefix, len(embeddings)))
+    return embeddings, labels
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1)
+    norms[norms == 0] = 1.0
+    return vectors / norms[:, np.newaxis]
+
+
+def _merge_top_k(best_scores, best_indices, scores, indices, k):
+    """Merge candidate scores (q x m) and their indices into the running top k (q x k), best first."""
+    scores = np.hstack([best_scores, scores])
+    indices = np.hstack([best_indices, indices])
+    if scores.shape[1] > k:
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        rows = np.arange(len(scores))[:, np.newaxis]
+        scores, indices = scores[rows, top], indices[rows, top]
+    order = np.argsort(-scores, axis=1, kind='mergesort')
+    rows = np.arange(len(scores))[:, np.newaxis]
+    return scores[rows, order], indices[rows, order]
+
+
+class NearestNeighbourIndex(object):
+    """Cosine nearest neighbours over entity or relation embeddings, on CPU.
+       The exact mode scans all vectors with blocked matrix products. The approximate mode (IVF) partitions the
+       vectors into list_n lists around mini-batch k-means centroids, and only scans the probe_n lists closest to
+       each query.
+       An index is saved as a directory of .npy files and a label file, the vectors are memory-mapped on load."""
+
+    def __init__(self, vectors, labels, centroids=None, list_order=None, list_offsets=None):
+        self.vectors = vectors
+        self.labels = labels
+        self.centroids = centroids
+        self._list_order = list_order
+        self._list_offsets = list_offsets
+        self._label_index = dict((label, i) for i, label in enumerate(labels))
+
+    @property
+    def approximate(self):
+        return self.centroids is not None
+
+    @classmethod
+    def build(cls, embeddings, labels, list_n=0, sample_size=100000, random_state=0, logger=None):
+        """Build an exact index, or an approximate one with list_n lists (the centroids are trained on a sample of
+           sample_size vectors)."""
+        logger = logger if logger else logging.getLogger()
+        vectors = _normalize(embeddings)
+        if not list_n:
+            return cls(vectors, labels)
+
+        t0 = time()
+        rng = np.random.RandomState(random_state)
+        sample = vectors[rng.choice(len(vectors), min(sample_size, len(vectors)), replace=False)]
+        k_means = MiniBatchKMeans(n_clusters=list_n, batch_size=max(1000, 3 * list_n), random_state=random_state)
+        k_means.fit(sample)
+        centroids = _normalize(k_means.cluster_centers_)
+        assignments = np.empty(len(vectors), dtype=np.int64)
+        for start in xrange(0, len(vectors), 65536):
+            assignments[start:start + 65536] = np.argmax(vectors[start:start + 65536].dot(centroids.T), axis=1)
+        list_order = np.argsort(assignments, kind='mergesort')
+        list_offsets = np.searchsorted(assignments[list_order], np.arange(list_n + 1))
+        logger.info('{} lists trained in {:.1f}s'.format(list_n, time() - t0))
+        return cls(vectors, labels, centroids, list_order, list_offsets)
+
+    def save(self, index_dir):
+        if not os.path.exists(index_dir):
+            os.makedirs(index_dir)
+        np.save(os.path.join(index_dir, 'vectors.npy'), self.vectors)
+        with codecs.open(os.path.join(index_dir, 'labels.txt'), 'w', encoding='utf-8') as f:
+            for label in self.labels:
+                f.write(u'{}\n'.format(label))
+        if self.approximate:
+            np.save(os.path.join(index_dir, 'centroids.npy'), self.centroids)
+            np.save(os.path.join(index_dir, 'list_order.npy'), self._list_order)
+            np.save(os.path.join(index_dir, 'list_offsets.npy'), self._list_offsets)
+
+    @classmethod
+    def load(cls, index_dir):
+        vectors = np.load(os.path.join(index_dir, 'vectors.npy'), mmap_mode='r')
+        with codecs.open(os.path.join(index_dir, 'labels.txt'), encoding='utf-8') as f:
+            labels = [line.rstrip(u'\n') for line in f]
+        if not os.path.exists(os.path.join(index_dir, 'centroids.npy')):
+            return cls(vectors, labels)
+        return cls(vectors, labels, np.load(os.path.join(index_dir, 'centroids.npy')),
+                   np.load(os.path.join(index_dir, 'list_order.npy')),
+                   np.load(os.path.join(index_dir, 'list_offsets.npy')))
+
+    def search(self, queries, k=10, probe_n=8, block_size=65536):
+        """Top k neighbours of every query vector. Returns (scores, indices), two len(queries) x k arrays,
+           best first. Approximate indexes may return fewer than k neighbours (index -1, score -inf)."""
+        queries = _normalize(np.atleast_2d(queries))
+        k = min(k, len(self.vectors))
+        if self.approximate:
+            return self._search_lists(queries, k, probe_n)
+        best_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+        best_indices = np.zeros((len(queries), 0), dtype=np.int64)
+        for start in xrange(0, len(self.vectors), block_size):
+            block = np.asarray(self.vectors[start:start + block_size])
+            scores = queries.dot(block.T)
+            if scores.shape[1] > k:
+                top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+                scores = scores[np.arange(len(scores))[:, np.newaxis], top]
+            else:
+                top = np.tile(np.arange(scores.shape[1]), (len(scores), 1))
+            best_scores, best_indices = _merge_top_k(best_scores, best_indices, scores, top + start, k)
+        return best_scores, best_indices
+
+    def _search_lists(self, queries, k, probe_n):
+        probe_n = min(probe_n, len(self.centroids))
+        probes = np.argpartition(-queries.dot(self.centroids.T), probe_n - 1, axis=1)[:, :probe_n]
+        best_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        best_indices = np.full((len(queries), k), -1, dtype=np.int64)
+        for i, query in enumerate(queries):
+            candidates = np.concatenate([self._list_order[self._list_offsets[j]:self._list_offsets[j + 1]]
+                                         for j in probes[i]])
+            if not len(candidates):
+                continue
+            candidates.sort()
+            scores = np.asarray(self.vectors[candidates]).dot(query)
+            top = np.argsort(-scores, kind='mergesort')[:k]
+            best_scores[i, :len(top)] = scores[top]
+            best_indices[i, :len(top)] = candidates[top]
+        return best_scores, best_indices
+
+    def search_labels(self, labels, k=10, probe_n=8, logger=None):
+        """Top k neighbours of indexed labels, excluding the label itself. Returns a list of [(label, score)], empty
+           for the labels that are not in the index (with a warning)."""
+        logger = logger if logger else logging.getLogger()
+        results = [[] for _ in labels]
+        known = []
+        for i, label in enumerate(labels):
+            if label in self._label_index:
+                known.append(i)
+            else:
+                logger.warning(u'{} is not in the index'.format(label))
+        if not known:
+            return results
+        indices = np.array([self._label_index[labels[i]] for i in known], dtype=np.int64)
+        scores, neighbours = self.search(np.asarray(self.vectors[indices]), k + 1, probe_n)
+        for row, (i, index) in enumerate(zip(known, indices)):
+            results[i] = [(self.labels[j], float(score)) for j, score in zip(neighbours[row], scores[row])
+                          if j >= 0 and not j == index][:k]
+        return results
+
+
+def _index_dir(dataset, embedding_model_name, embedding_type):
+    return 'data/{}/embeddings/{}_{}_index'.format(dataset, embedding_model_name, embedding_type)
+
+
+@begin.subcommand
+def build(dataset, embedding_model_name, embedding_type, list_n=0):
+    """Build the index of an embedding file, exact by default, approximate with --list-n lists
+       (about 4 * sqrt(n) is a good start)."""
+    with open('config/logging_config.yaml') as f:
+        logging.config.dictConfig(yaml.load(f))
+    logger = logging.getLogger('nn_index')
+
+    embeddings, labels = load_embedding_file(dataset, embedding_model_name, embedding_type)
+    logger.info('{} embeddings loaded'.format(len(labels)))
+    index = NearestNeighbourIndex.build(embeddings, labels, int(list_n), logger=logger)
+    index_dir = _index_dir(dataset, embedding_model_name, embedding_type)
+    index.save(index_dir)
+    logger.info('Index saved at {}'.format(index_dir))
+
+
+@begin.subcommand
+def query(dataset, embedding_model_name, embedding_type, k=10, probe_n=8, *labels):
+    """Log the k nearest neighbours of every label."""
+    with open('config/logging_config.yaml') as f:
+        logging.config.dictConfig(yaml.load(f))
+    logger = logging.getLogger('nn_index')
+
+    index = NearestNeighbourIndex.load(_index_dir(dataset, embedding_model_name, embedding_type))
+    labels = [label.decode('utf-8') for label in labels]
+    t0 = time()
+    results = index.search_labels(labels, int(k), int(probe_n), logger)
+    logger.info('{} queries in {:.3f}s'.format(len(labels), time() - t0))
+    for label, neighbours in zip(labels, results):
+        logger.info(u'{}: {}'.format(label, u', '.join(u'{} ({:.3f})'.format(n, score) for n, score in neighbours)))
+
+
+@begin.start
+def main():
+    pass
+
+if begin.start():
+    pass
@@ -0,0 +1,174 @@
+# -*- coding: utf8 -*-
+
+import io
+import os
+import codecs
+
+
+class PackedCorpus(object):
+    """A corpus packed into a few large shard files, instead of one file per document.
+       manifest.tsv holds one line per document: doc id, shard, byte offset, byte length and initial status.
+       Status changes (checkpoints) are appended to status.log, so no per-document file is ever touched."""
+
+    _manifest_name = 'manifest.tsv'
+    _status_log_name = 'status.log'
+    _shard_name = 'shard-{:05d}.pack'
+
+    def __init__(self, corpus_dir):
+        self._corpus_dir = corpus_dir
+        self._docs = []
+        self._index = {}
+        self._status = {}
+        self._status_fd = None
+
+        with codecs.open(os.path.join(corpus_dir, self._manifest_name), encoding='utf-8') as f:
+            for line in f:
+                # A partially written last line (after a crash) is ignored, as are the status lines below.
+                if line.endswith(u'\n'):
+                    doc_id, shard, offset, length, status = line.rstrip(u'\n').split(u'\t')
+                    self._index[doc_id] = len(self._docs)
+                    self._docs.append((doc_id, int(shard), int(offset), int(length)))
+                    self._status[doc_id] = status
+        status_log = os.path.join(corpus_dir, self._status_log_name)
+        if os.path.exists(status_log):
+            with codecs.open(status_log, encoding='utf-8') as f:
+                for line in f:
+                    if line.endswith(u'\n'):
+                        doc_id, status = line.rstrip(u'\n').split(u'\t')
+                        self._status[doc_id] = status
+
+    @classmethod
+    def is_packed(cls, corpus_dir):
+        return os.path.isfile(os.path.join(corpus_dir, cls._manifest_name))
+
+    def __len__(self):
+        return len(self._docs)
+
+    def __iter__(self):
+        return self.documents()
+
+    def doc_ids(self, skip_status=None):
+        return [doc_id for doc_id, _, _, _ in self._docs if skip_status is None or
+                not self._status[doc_id] == skip_status]
+
+    def documents(self, skip_status=None, doc_ids=None):
+        """Yield (doc_id, text) in manifest order, optionally skipping the documents with status skip_status.
+           Documents are read sequentially from one open shard at a time."""
+        shard_no, shard = None, None
+        try:
+            for doc_id in (self.doc_ids(skip_status) if doc_ids is None else doc_ids):
+                _, doc_shard, offset, length = self._docs[self._index[doc_id]]
+                if not doc_shard == shard_no:
+                    if shard:
+                        shard.close()
+                    shard_no = doc_shard
+                    shard = open(self._shard_path(self._corpus_dir, shard_no), 'rb')
+                if not shard.tell() == offset:
+                    shard.seek(offset)
+                yield doc_id, shard.read(length).decode('utf-8')
+        finally:
+            if shard:
+                shard.close()
+
+    def read(self, doc_id):
+        _, shard_no, offset, length = self._docs[self._index[doc_id]]
+        with open(self._shard_path(self._corpus_dir, shard_no), 'rb') as shard:
+            shard.seek(offset)
+            return shard.read(length).decode('utf-8')
+
+    def status(self, doc_id):
+        return self._status[doc_id]
+
+    def mark(self, doc_id, status):
+        """Checkpoint the status of a document. Several processes can mark documents of the same corpus,
+           every status line is written with a single append."""
+        if self._status_fd is None:
+            self._status_fd = os.open(os.path.join(self._corpus_dir, self._status_log_name),
+                                      os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        os.write(self._status_fd, u'{}\t{}\n'.format(doc_id, status).encode('utf-8'))
+        self._status[doc_id] = status
+
+    def close(self):
+        if self._status_fd is not None:
+            os.close(self._status_fd)
+            self._status_fd = None
+
+    @classmethod
+    def _shard_path(cls, corpus_dir, shard_no):
+        return os.path.join(corpus_dir, cls._shard_name.format(shard_no))
+
+
+class PackedCorpusWriter(object):
+    """Appends documents to the shards of a packed corpus, starting a new shard after shard_size bytes.
+       The manifest line of a document is flushed right after its text, so an interrupted run can be resumed:
+       reopening the corpus drops any text written after the last manifest line."""
+
+    def __init__(self, corpus_dir, shard_size=1024 * 1024 * 1024, status='new'):
+        self._corpus_dir = corpus_dir
+        self._shard_size = int(shard_size)
+        self._status = status
+        self._doc_ids = set()
+        self._shard_no = 0
+        self._offset = 0
+
+        if not os.path.exists(corpus_dir):
+            os.makedirs(corpus_dir)
+        manifest_file = os.path.join(corpus_dir, PackedCorpus._manifest_name)
+        manifest_end = 0
+        if os.path.exists(manifest_file):
+            with open(manifest_file, 'rb') as f:
+                for line in f:
+                    if line.endswith('\n'):
+                        manifest_end += len(line)
+                        doc_id, shard, offset, length, _ = line.decode('utf-8').rstrip(u'\n').split(u'\t')
+                        self._doc_ids.add(doc_id)
+                        self._shard_no, self._offset = int(shard), int(offset) + int(length)
+        self._manifest = io.open(manifest_file, 'a', encoding='utf-8')
+        # Drop a partially written last manifest line.
+        self._manifest.truncate(manifest_end)
+        self._shard = self._open_shard()
+
+    def __contains__(self, doc_id):
+        if isinstance(doc_id, str):
+            doc_id = doc_id.decode('utf-8')
+        return doc_id in self._doc_ids
+
+    def _open_shard(self):
+        shard_file = PackedCorpus._shard_path(self._corpus_dir, self._shard_no)
+        shard = open(shard_file, 'ab')
+        # Drop the text of a document whose manifest line was never written.
+        shard.truncate(self._offset)
+        shard.seek(self._offset)
+        return shard
+
+    def add(self, doc_id, text):
+        if isinstance(doc_id, str):
+            doc_id = doc_id.decode('utf-8')
+        if u'\t' in doc_id or u'\n' in doc_id:
+            raise ValueError(u'Invalid document id: {}'.format(doc_id))
+        if doc_id in self._doc_ids:
+            raise ValueError(u'Duplicate document id: {}'.format(doc_id))
+        if self._offset and self._offset >= self._shard_size:
+            self._shard.close()
+            self._shard_no += 1
+            self._offset = 0
+            self._shard = self._open_shard()
+        data = text.encode('utf-8')
+        self._shard.write(data)
+        self._shard.flush()
+        self._manifest.write(u'{}\t{}\t{}\t{}\t{}\n'.format(doc_id, self._shard_no, self._offset, len(data),
+                                                             self._status))
+        self._manifest.flush()
+        self._doc_ids.add(doc_id)
+        self._offset += len(data)
+
+    def close(self):
+        self._shard.close()
+        self._manifest.close()
+
+
+def iter_packed_documents(corpus_dir):
+    """Yield (doc_id, f) like corpus.iter_documents, where f is an in-memory stream of the document."""
+    corpus = PackedCorpus(corpus_dir)
+    for doc_id, text in corpus:
+        yield doc_id, io.StringIO(text)
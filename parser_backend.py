@@ -0,0 +1,82 @@
+# -*- coding: utf8 -*-
+
+import json
+import codecs
+import jsonrpclib
+
+
+class ParserBackend(object):
+    """Interface of a dependency parser. parse() returns the raw JSON response of the CoreNLP server."""
+
+    def parse(self, sentence):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class JsonRpcParser(ParserBackend):
+    """A live CoreNLP server behind JSON-RPC."""
+
+    def __init__(self, parser_server='http://localhost:8084'):
+        self._server = jsonrpclib.Server(parser_server)
+
+    def parse(self, sentence):
+        return self._server.parse(sentence)
+
+
+class RecordingParser(ParserBackend):
+    """Wraps another backend and appends every raw response to a record file (one JSON object per line)."""
+
+    def __init__(self, backend, record_file):
+        self._backend = backend
+        self._record_out = codecs.open(record_file, 'a', encoding='utf-8')
+
+    def parse(self, sentence):
+        response = self._backend.parse(sentence)
+        self._record_out.write(u'{}\n'.format(json.dumps({'sentence': sentence, 'response': response},
+                                                         ensure_ascii=False)))
+        return response
+
+    def close(self):
+        self._record_out.close()
+        self._backend.close()
+
+
+class ReplayParser(ParserBackend):
+    """Serves the responses of a record file written by RecordingParser, no parser server needed."""
+
+    def __init__(self, record_file):
+        self._responses = {}
+        self._sentences = []
+        with codecs.open(record_file, encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    record = json.loads(line)
+                    if record['sentence'] not in self._responses:
+                        self._sentences.append(record['sentence'])
+                    self._responses[record['sentence']] = record['response']
+
+    @property
+    def sentences(self):
+        return self._sentences
+
+    def parse(self, sentence):
+        try:
+            return self._responses[sentence]
+        except KeyError:
+            raise KeyError(u'No recorded parse for: {}'.format(sentence))
+
+
+def get_parser(parser_server=None, record_file=None, replay_file=None):
+    """Build a parser backend. parser_server can be a server url or a ParserBackend."""
+    if replay_file:
+        return ReplayParser(replay_file)
+    if isinstance(parser_server, ParserBackend):
+        backend = parser_server
+    else:
+        backend = JsonRpcParser(parser_server if parser_server else 'http://localhost:8084')
+    if record_file:
+        backend = RecordingParser(backend, record_file)
+    return backend
@@ -2,75 +2,337 @@
 
 import os
 import re
+import errno
+import time
 import codecs
+import shutil
+import tempfile
+import multiprocessing
+import logging
 import logging.config
 import yaml
+import begin
 from segtok.segmenter import split_multi
+from corpus import iter_corpus, iter_corpus_files, iter_documents
+from packed_corpus import PackedCorpusWriter
+
+
+def _makedirs(path):
+    # Worker processes can create the same directory at the same time.
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if not e.errno == errno.EEXIST:
+            raise
+
+
+class TextCleaner(object):
+    """Removes parentheses, brackets, URLs, emails and list item markers in a single pass.
+       The output is the same as substituting the reference pattern below, but the spans that made the regex engine
+       backtrack (whitespace runs, unclosed brackets, hyphenated words and URL bodies) are resolved with cached
+       lookups, so the time is linear in the length of the text."""
+
+    _flags = re.UNICODE | re.IGNORECASE
+
+    reference_pattern = re.compile('|'.join([
+        r'(^\W*\s*)',   # Preceding non-word characters
+        r'(\s*\([^()]*\))',    # Parentheses
+        r'(\s*\[.*\])',    # Parentheses
+        r'(\b(([\w-]+://?|www[.])[^\s()<>]+(?:\([\w\d]+\)|([^[:punct:]\s]|/))))',   # URLs
+        r'(^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$)',  # emails
+        r'([A-Za-z0-9]\))',   # List item markers with just one parenthesis
+    ]), _flags)
+
+    # The preceding non-word characters always match at the start of the text, so the email pattern, which is also
+    # anchored there, can never match and is left out.
+    _leading = re.compile(r'\W*', _flags)
+    # Finds where the reference pattern can match. A parenthesis or bracket match can only start where a whitespace
+    # run starts, and a scheme URL only at the first word boundary of a [\w-] run, since a match at any later
+    # position would have been found there first. Where a bracket or URL match ends is resolved outside the regex.
+    _trigger = re.compile(r"""
+        (?<!\s)\s*\([^()]*\)
+        |(?P<bracket>(?<!\s)\s*\[)
+        |(?P<scheme>(?<![\w-])(?P<dashes>-*)\b[\w-]+:/(?P<slash>/)?)
+        |(?P<www>\bwww[.])
+        |[A-Za-z0-9]\)
+    """, _flags | re.VERBOSE)
+    # A scheme URL in a [\w-] run that started before the search position (cut by the leading strip).
+    _scheme_in_run = re.compile(r'[\w-]*?(?P<scheme>\b[\w-]+:/(?P<slash>/)?)', _flags)
+    _run = re.compile(r'[\w-]*', _flags)
+    _run_char = re.compile(r'[\w-]', _flags)
+    _url_body = re.compile(r'[^\s()<>]*', _flags)
+    _url_paren = re.compile(r'\([\w\d]+\)', _flags)
+    _url_last_char = re.compile(r'[^[:punct:]', _flags)
+    _space = re.compile(r'\s', _flags)
+
+    def __init__(self, text):
+        self._text = text
+        self._len = len(text)
+        # (from, end of line, last "]" on the line) of the last bracket lookup
+        self._line = (0, -1, -1)
+        # (from, end of body, last "/" in the body) of the last URL body lookup
+        self._body = (0, -1, -1)
+
+    @classmethod
+    def clean(cls, text, strip_leading=True):
+        return cls(text)._clean(strip_leading)
+
+    @classmethod
+    def reference_clean(cls, text):
+        return cls.reference_pattern.sub('', text)
+
+    def _clean(self, strip_leading):
+        text = self._text
+        pieces = []
+        pos = last = 0
+        if strip_leading and text:
+            pos = last = self._leading.match(text).end()
+            if not pos:
+                # An empty match at the start; like re.sub, the next match is only searched from the next character.
+                pos = 1
+            run_end = self._run.match(text, pos).end()
+            if run_end > pos and self._run_char.match(text, pos - 1) and text[run_end:run_end + 2] == ':/':
+                m = self._scheme_in_run.match(text, pos)
+                if m:
+                    end = self._scheme_end(m)
+                    if end >= 0:
+                        pieces.append(text[last:m.start('scheme')])
+                        last = pos = end
+        while pos < self._len:
+            m = self._trigger.search(text, pos)
+            if not m:
+                break
+            start, end = m.start(), m.end()
+            if m.group('bracket') is not None:
+                end = self._bracket_end(end - 1)
+            elif m.group('scheme') is not None:
+                start = m.end('dashes')
+                end = self._scheme_end(m)
+            elif m.group('www') is not None:
+                end = self._url_end(end)
+            if end < 0:
+                # No match here; nothing else can match before the next position either.
+                pos = m.start() + 1
+                continue
+            pieces.append(text[last:start])
+            last = pos = end
+        pieces.append(text[last:])
+        return text[:0].join(pieces)
+
+    def _scheme_end(self, m):
+        end = self._url_end(m.end())
+        if end < 0 and m.group('slash') is not None:
+            # The second slash is optional, so the body may also start there.
+            end = self._url_end(m.end() - 1)
+        return end
+
+    def _bracket_end(self, bracket):
+        """End of ".*\]" after the bracket: the last "]" on its line, or -1."""
+        line_from, eol, last_close = self._line
+        if not line_from <= bracket < eol:
+            eol = self._text.find('\n', bracket)
+            if eol < 0:
+                eol = self._len
+            last_close = self._text.rfind(']', bracket, eol)
+            self._line = (bracket, eol, last_close)
+        return last_close + 1 if last_close > bracket else -1
+
+    def _url_end(self, q):
+        """End of "[^\s()<>]+(?:\([\w\d]+\)|([^[:punct:]\s]|/))" starting at q, or -1.
+           The greedy body runs up to e and then backtracks, so the match can only end right after e, right after e - 1
+           or after the last "/" in the body."""
+        text = self._text
+        body_from, e, last_slash = self._body
+        if not body_from <= q < e:
+            e = self._url_body.match(text, q).end()
+            last_slash = text.rfind('/', q, e)
+            self._body = (q, e, last_slash)
+        if e == q:
+            return -1
+        # The body is maximal, the tail starts at e.
+        if e < self._len:
+            if text[e] == '(':
+                m = self._url_paren.match(text, e)
+                if m:
+                    return m.end()
+            if self._url_last_char.match(text, e) and self._space.match(text, e + 1) and text[e + 2:e + 3] == ']':
+                return e + 3
+        # The body gives back one character, the tail starts at e - 1.
+        if e - 1 > q:
+            if self._url_last_char.match(text, e - 1) and self._space.match(text, e) and text[e + 1:e + 2] == ']':
+                return e + 2
+            if last_slash > q:
+                return last_slash + 1
+        return -1
 
 
 class Sentences(object):
 
-    def __init__(self, dataset, logger):
+    def __init__(self, dataset, logger, chunk_size=4 * 1024 * 1024):
         self.logger = logger
         self._dataset = dataset
         self._raw_text_dir = 'data/{}/raw'.format(self._dataset)
         self._preprocessed_text_dir = 'data/{}/preprocessed'.format(self._dataset)
+        self._packed_text_dir = 'data/{}/preprocessed_packed'.format(self._dataset)
+        # Number of characters read at a time. Documents larger than this are cleaned and segmented chunk by chunk.
+        self._chunk_size = chunk_size
 
     def __iter__(self):
-        for root, _, files in os.walk(self._raw_text_dir):
-            for fn in files:
-                if fn.endswith('.txt'):
-                    filename = os.path.join(root, fn)
-                    f = codecs.open(filename, encoding='utf-8')
-                    text = f.read()
-                    if text:
-                        text = self.process_text(text)
-                        for sent in split_multi(text):
-                            # Discard very long and very short sentences
-                            if sent and len(sent) < 1000 and len(sent.split()) > 2:
-                                sent = sent.strip()
-                                yield filename, sent
-                    f.close()
-                    # Move the preprocessed files to a temp directory, so we know which files are done.
-                    done_filename = filename.replace('/raw/', '/raw_preprocessed/')
-                    if not os.path.exists(os.path.dirname(done_filename)):
-                        os.makedirs(os.path.dirname(done_filename))
-                    os.rename(filename, done_filename)
-
-    def save(self):
-
-        # # First empty the preprocessed dir
-        # file_list = [os.path.join(self._preprocessed_text_dir, d) for d in os.listdir(self._preprocessed_text_dir)
-        #              if os.path.isdir(os.path.join(self._preprocessed_text_dir, d))]
-        # for d in file_list:
-        #     for f in os.listdir(d):
-        #         os.remove(os.path.join(d, f))
-
-        for filename, sent in self.__iter__():
-            filename = filename.replace('/raw/', '/preprocessed/')
-            if not os.path.exists(os.path.dirname(filename)):
-                os.makedirs(os.path.dirname(filename))
-            self.logger.debug(u'{} {}'.format(filename, sent))
-            f = codecs.open(filename, 'a', encoding='utf-8')
-            f.write(u'{}\n'.format(sent))
-            f.close()
+        for filename in self._raw_files():
+            for name, f in iter_documents(filename):
+                for sent in self._sentences(f):
+                    yield name, sent
+            self._mark_done(filename)
+
+    def _raw_files(self):
+        # Loose, compressed and archived text files, see corpus.iter_documents.
+        return iter_corpus_files(self._raw_text_dir)
+
+    def _read_chunks(self, f):
+        """Read the text in chunks of about chunk_size characters.
+           A chunk is only cut at a paragraph break, which is always a sentence boundary."""
+        buf = u''
+        while True:
+            data = f.read(self._chunk_size)
+            if not data:
+                break
+            buf += data
+            cut = buf.rfind(u'\n\n', max(0, len(buf) - len(data) - 1))
+            if cut >= 0:
+                yield buf[:cut + 2]
+                buf = buf[cut + 2:]
+        if buf:
+            yield buf
+
+    def _sentences(self, f):
+        for i, text in enumerate(self._read_chunks(f)):
+            # Leading non-word characters are only stripped at the start of the document.
+            text = self.process_text(text, strip_leading=(i == 0))
+            for sent in split_multi(text):
+                # Discard very long and very short sentences
+                if sent and len(sent) < 1000 and len(sent.split()) > 2:
+                    sent = sent.strip()
+                    yield sent
+
+    @staticmethod
+    def _mark_done(filename):
+        # Move the preprocessed files to a temp directory, so we know which files are done.
+        done_filename = filename.replace('/raw/', '/raw_preprocessed/')
+        _makedirs(os.path.dirname(done_filename))
+        os.rename(filename, done_filename)
+
+    def _write_sentences(self, f, output_filename):
+        """Write the sentences of a document to output_filename through one buffered writer.
+           The output only appears (atomically renamed) once the document is finished. Returns the sentence count."""
+        _makedirs(os.path.dirname(output_filename))
+        tmp_filename = output_filename + '.tmp'
+        sentence_n = 0
+        with codecs.open(tmp_filename, 'w', encoding='utf-8', buffering=1024 * 1024) as f_out:
+            for sent in self._sentences(f):
+                f_out.write(u'{}\n'.format(sent))
+                sentence_n += 1
+        if sentence_n:
+            os.rename(tmp_filename, output_filename)
+        else:
+            os.remove(tmp_filename)
+        return sentence_n
+
+    def preprocess_file(self, filename, output_dir=None):
+        """Preprocess every document of a raw (possibly compressed or archived) file into output_dir,
+           which defaults to the preprocessed directory of the dataset. Returns the sentence count."""
+        output_dir = output_dir if output_dir else self._preprocessed_text_dir
+        sentence_n = 0
+        for name, f in iter_documents(filename):
+            output_filename = os.path.join(output_dir, os.path.relpath(name, self._raw_text_dir))
+            sentence_n += self._write_sentences(f, output_filename)
+        return sentence_n
+
+    def pack_file(self, filename):
+        """Preprocess every document of a raw file in memory, for a packed corpus.
+           Returns a list of (doc_id, text, sentence count), the text holding one sentence per line."""
+        docs = []
+        for name, f in iter_documents(filename):
+            sentences = list(self._sentences(f))
+            if sentences:
+                docs.append((os.path.relpath(name, self._raw_text_dir),
+                             u''.join(u'{}\n'.format(sent) for sent in sentences), len(sentences)))
+        return docs
+
+    def _preprocess_and_mark_done(self, filename, packed=False):
+        # A packed file is marked done by the process writing the packed corpus, once its documents are written.
+        byte_n = os.path.getsize(filename)
+        if packed:
+            docs = self.pack_file(filename)
+            return filename, byte_n, sum(doc[2] for doc in docs), docs
+        sentence_n = self.preprocess_file(filename)
+        self._mark_done(filename)
+        return filename, byte_n, sentence_n, None
+
+    def save(self, processes=1, packed=False):
+        """Preprocess all raw files, in a pool of worker processes if processes > 1.
+           Each file is handled by a single worker, which also marks it done.
+           With packed, the documents are appended to a packed corpus (see packed_corpus.py) instead of being
+           written as one file each. Documents already in the packed corpus are skipped when resuming."""
+        byte_n, sentence_n = 0, 0
+        t0 = time.time()
+        writer = PackedCorpusWriter(self._packed_text_dir) if packed else None
+        if processes > 1:
+            pool = multiprocessing.Pool(processes)
+            tasks = ((self._dataset, self._chunk_size, filename, packed) for filename in self._raw_files())
+            results = pool.imap_unordered(_preprocess_worker, tasks)
+        else:
+            pool = None
+            results = (self._preprocess_and_mark_done(filename, packed) for filename in self._raw_files())
+        for filename, file_byte_n, file_sentence_n, docs in results:
+            if writer:
+                for doc_id, text, _ in docs:
+                    if doc_id not in writer:
+                        writer.add(doc_id, text)
+                self._mark_done(filename)
+            byte_n += file_byte_n
+            sentence_n += file_sentence_n
+            self.logger.debug(u'{}: {} sentences'.format(filename, file_sentence_n))
+        if pool:
+            pool.close()
+            pool.join()
+        if writer:
+            writer.close()
+        self._log_throughput(byte_n, sentence_n, time.time() - t0)
+
+    def benchmark(self, repeat=1, processes=1):
+        """Measure the preprocessing throughput over the raw files without moving them or writing any output,
+           in a pool of worker processes if processes > 1 (as save())."""
+        output_dir = tempfile.mkdtemp()
+        byte_n, sentence_n = 0, 0
+        t0 = time.time()
+        pool = multiprocessing.Pool(processes) if processes > 1 else None
+        try:
+            for _ in xrange(repeat):
+                if pool:
+                    tasks = ((self._dataset, self._chunk_size, filename, output_dir) for filename in self._raw_files())
+                    results = pool.imap_unordered(_benchmark_worker, tasks)
+                else:
+                    results = ((os.path.getsize(filename), self.preprocess_file(filename, output_dir))
+                               for filename in self._raw_files())
+                for file_byte_n, file_sentence_n in results:
+                    byte_n += file_byte_n
+                    sentence_n += file_sentence_n
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+            shutil.rmtree(output_dir)
+        return self._log_throughput(byte_n, sentence_n, time.time() - t0)
+
+    def _log_throughput(self, byte_n, sentence_n, elapsed_time):
+        throughput = byte_n / 1024.0 / 1024.0 / elapsed_time if elapsed_time else 0.0
+        self.logger.info('{} bytes, {} sentences in {:.2f}s ({:.2f} MB/s)'.format(
+            byte_n, sentence_n, elapsed_time, throughput))
+        return throughput
 
     @staticmethod
-    def process_text(text):
-        replacement = [
-            r'(^\W*\s*)',   # Preceding non-word characters
-            r'(\s*\([^()]*\))',    # Parentheses
-            r'(\s*\[.*\])',    # Parentheses
-            r'(\b(([\w-]+://?|www[.])[^\s()<>]+(?:\([\w\d]+\)|([^[:punct:]\s]|/))))',   # URLs
-            r'(^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$)',  # emails
-            r'([A-Za-z0-9]\))',   # List item markers with just one parenthesis
-            # r'((Fig\.?u?r?e?\s\d{1,3}\.?))',  # Figure caption
-            # r'(Table\.?\s\d{1,3}\.?)',    # Table caption
-            # r'(([A-Z]\S+)+(\sand\s)?([A-Z]\S+)?\s(et al.)?,?\s*\d{4}[a-z]?[;|,]*)',   # Citations
-            # r'(([A-Z]\S+)+(\sand\s)?([A-Z]\S+)?\s(et al.)?,?\s*\(\d{4}[a-z]?\)[;|,]*)',   # Citations
-        ]
-        replacement_pattern = re.compile('|'.join(replacement), re.UNICODE | re.IGNORECASE)
-        text = re.sub(replacement_pattern, '', text)
+    def process_text(text, strip_leading=True):
+        text = TextCleaner.clean(text, strip_leading)
 
         # Replace " ." with "." for sentence segmentation.
         text = text.replace(' .', '.')
@@ -81,14 +343,110 @@ class Sentences(object):
         return text
 
 
-if __name__ == '__main__':
+def _preprocess_worker(args):
+    dataset, chunk_size, filename, packed = args
+    sents = Sentences(dataset, logging.getLogger('preprocess'), chunk_size)
+    return sents._preprocess_and_mark_done(filename, packed)
+
+
+def _benchmark_worker(args):
+    dataset, chunk_size, filename, output_dir = args
+    sents = Sentences(dataset, logging.getLogger('preprocess'), chunk_size)
+    return os.path.getsize(filename), sents.preprocess_file(filename, output_dir)
+
+
+@begin.subcommand
+def preprocess(dataset, processes=1, packed=False):
+    with open('config/logging_config.yaml') as f:
+        logging.config.dictConfig(yaml.load(f))
+    logger = logging.getLogger('preprocess')
+
+    sents = Sentences(dataset, logger)
+    sents.save(int(processes), packed=bool(packed))
+
+
+@begin.subcommand
+def pack(dataset, shard_size=1024 * 1024 * 1024):
+    """Pack the preprocessed files of a dataset into data/<dataset>/preprocessed_packed.
+       The preprocessed files are left in place, the packing can be resumed."""
     with open('config/logging_config.yaml') as f:
         logging.config.dictConfig(yaml.load(f))
     logger = logging.getLogger('preprocess')
 
-    # dataset = 'test'
-    dataset = 'pmc_mini'
-    # dataset = 'RiMG75'
+    data_dir = 'data/{}/preprocessed'.format(dataset)
+    writer = PackedCorpusWriter('data/{}/preprocessed_packed'.format(dataset), int(shard_size))
+    doc_n = 0
+    for filename, f in iter_corpus(data_dir):
+        doc_id = os.path.relpath(filename, data_dir)
+        if doc_id not in writer:
+            writer.add(doc_id, f.read())
+            doc_n += 1
+    writer.close()
+    logger.info('{} documents packed'.format(doc_n))
+
+
+@begin.subcommand
+def benchmark(dataset, repeat=1, processes=1):
+    with open('config/logging_config.yaml') as f:
+        logging.config.dictConfig(yaml.load(f))
+    logger = logging.getLogger('preprocess')
 
     sents = Sentences(dataset, logger)
-    sents.save()
+    sents.benchmark(int(repeat), int(processes))
+
+
+@begin.subcommand
+def check_cleaner(dataset):
+    """Compare the cleaner with the reference pattern on the raw files of a dataset (the golden corpus)."""
+    with open('config/logging_config.yaml') as f:
+        logging.config.dictConfig(yaml.load(f))
+    logger = logging.getLogger('preprocess')
+
+    doc_n, mismatch_n = 0, 0
+    for name, f in iter_corpus('data/{}/raw'.format(dataset)):
+        text = f.read()
+        doc_n += 1
+        if not TextCleaner.clean(text) == TextCleaner.reference_clean(text):
+            mismatch_n += 1
+            logger.error(u'Cleaner output differs from the reference for {}'.format(name))
+    logger.info('{} documents checked, {} mismatches'.format(doc_n, mismatch_n))
+    if mismatch_n:
+        raise SystemExit(1)
+
+
+@begin.subcommand
+def benchmark_cleaner(size=100000, max_seconds=1.0):
+    """Time the cleaner on inputs that made the former regex backtrack, and fail if any case exceeds max_seconds."""
+    with open('config/logging_config.yaml') as f:
+        logging.config.dictConfig(yaml.load(f))
+    logger = logging.getLogger('preprocess')
+
+    size, max_seconds = int(size), float(max_seconds)
+    cases = [
+        ('plain text', u'lorem ipsum dolor sit amet. ' * (size / 28)),
+        ('whitespace run', u' ' * size + u'x'),
+        ('unclosed brackets', u'[a ' * (size / 3)),
+        ('unclosed parentheses', u'(a ' * (size / 3)),
+        ('hyphenated run', u'a-' * (size / 2)),
+        ('repeated www.', u'www.' * (size / 4)),
+        ('long URL body', u'http://' + u'a' * size + u' ' * size),
+    ]
+    slow_n = 0
+    for name, text in cases:
+        t0 = time.time()
+        TextCleaner.clean(text)
+        elapsed_time = time.time() - t0
+        logger.info('{}: {} characters in {:.4f}s'.format(name, len(text), elapsed_time))
+        if elapsed_time > max_seconds:
+            slow_n += 1
+            logger.error('{} took longer than {}s'.format(name, max_seconds))
+    if slow_n:
+        raise SystemExit(1)
+
+
+@begin.start
+def main():
+    pass
+
+if begin.start():
+    pass
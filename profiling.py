@@ -0,0 +1,151 @@
+# -*- coding: utf8 -*-
+
+import time
+import atexit
+import signal
+import pstats
+import logging
+import cProfile
+
+from collections import Counter
+
+
+class _Profiler(object):
+    """Base of the profilers started by the --profile option of the entry points.
+       The profile covers the first `seconds` seconds of the run (the whole run if seconds is 0), and is written to
+       output_file when the window ends or at exit, whichever comes first. Only the main process is profiled.
+       The signals of the profilers restart interrupted system calls, so a blocking read from the parser server or
+       MySQL does not fail with EINTR while profiling."""
+
+    def __init__(self, output_file, seconds=0, logger=None):
+        self.logger = logger if logger else logging.getLogger()
+        self._output_file = output_file
+        self._seconds = float(seconds)
+        self._running = False
+        # Count and total time of the blocks timed with utils.timeit, by name.
+        self._timings = {}
+
+    @property
+    def running(self):
+        return self._running
+
+    def start(self):
+        self._running = True
+        atexit.register(self.stop)
+
+    def stop(self):
+        if not self._running:
+            return
+        self._running = False
+        self._write_stats()
+        self._log_timings()
+
+    def record_timing(self, name, seconds):
+        timing = self._timings.get(name)
+        if timing is None:
+            timing = self._timings[name] = [0, 0.0]
+        timing[0] += 1
+        timing[1] += seconds
+
+    def _log_timings(self):
+        for name, (call_n, total_time) in sorted(self._timings.items(), key=lambda item: -item[1][1]):
+            self.logger.info('{:>10.3f}s {:>10} [{}] (timeit)'.format(total_time, call_n, name))
+
+    def _write_stats(self):
+        raise NotImplementedError
+
+
+class CProfiler(_Profiler):
+    """Deterministic profile with cProfile, the window is ended by SIGALRM. Writes a pstats file."""
+
+    def __init__(self, output_file, seconds=0, logger=None):
+        super(CProfiler, self).__init__(output_file, seconds, logger)
+        self._profile = cProfile.Profile()
+
+    def start(self):
+        super(CProfiler, self).start()
+        if self._seconds > 0:
+            signal.signal(signal.SIGALRM, lambda signum, frame: self.stop())
+            signal.siginterrupt(signal.SIGALRM, False)
+            signal.setitimer(signal.ITIMER_REAL, self._seconds)
+        self._profile.enable()
+
+    def _write_stats(self):
+        self._profile.disable()
+        self._profile.dump_stats(self._output_file)
+        self.logger.info('Profile written to {} (read it with pstats)'.format(self._output_file))
+        stats = pstats.Stats(self._profile)
+        for func, (_, call_n, _, cumulative_time, _) in sorted(stats.stats.items(),
+                                                              key=lambda item: -item[1][3])[:20]:
+            self.logger.info('{:>10.3f}s {:>10} {}:{}({})'.format(cumulative_time, call_n, *func))
+
+
+class SamplingProfiler(_Profiler):
+    """Statistical profile, the stack of the main thread is sampled every `interval` seconds of CPU time
+       (SIGPROF, so waiting on the parser server or MySQL is not sampled).
+       Writes the samples in the collapsed stack format of flame graph tools, one `frame;frame;... count` line
+       per distinct stack."""
+
+    def __init__(self, output_file, seconds=0, logger=None, interval=0.005):
+        super(SamplingProfiler, self).__init__(output_file, seconds, logger)
+        self._interval = float(interval)
+        self._samples = Counter()
+        self._end_time = None
+
+    def start(self):
+        super(SamplingProfiler, self).start()
+        self._end_time = time.time() + self._seconds if self._seconds > 0 else None
+        signal.signal(signal.SIGPROF, self._sample)
+        signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, self._interval, self._interval)
+
+    def _sample(self, signum, frame):
+        if self._end_time is not None and time.time() >= self._end_time:
+            self.stop()
+            return
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('{}:{}:{}'.format(code.co_filename, code.co_name, code.co_firstlineno))
+            frame = frame.f_back
+        self._samples[';'.join(reversed(stack))] += 1
+
+    def _write_stats(self):
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        with open(self._output_file, 'w') as f:
+            for stack, n in self._samples.most_common():
+                f.write('{} {}\n'.format(stack, n))
+        sample_n = sum(self._samples.values())
+        self.logger.info('{} samples written to {}'.format(sample_n, self._output_file))
+        own_samples = Counter()
+        for stack, n in self._samples.items():
+            own_samples[stack.rsplit(';', 1)[-1]] += n
+        for func, n in own_samples.most_common(20):
+            self.logger.info('{:>6.1f}% {}'.format(100.0 * n / sample_n, func))
+
+
+# The profiler started by start_profiler, if any.
+_profiler = None
+
+
+def active_profiler():
+    """The running profiler of this process, or None."""
+    if _profiler is not None and _profiler.running:
+        return _profiler
+    return None
+
+
+def start_profiler(output_file, seconds=0, mode='cprofile', logger=None):
+    """Start profiling the rest of the run, mode is cprofile or sampling. Returns the profiler.
+       This is what the global --profile, --profile-seconds and --profile-mode options of the entry points call.
+       The blocks timed with utils.timeit during the window are added to the summary logged with the profile."""
+    global _profiler
+    if mode == 'cprofile':
+        profiler = CProfiler(output_file, seconds, logger)
+    elif mode == 'sampling':
+        profiler = SamplingProfiler(output_file, seconds, logger)
+    else:
+        raise ValueError('Unknown profile mode: {}'.format(mode))
+    profiler.start()
+    _profiler = profiler
+    return profiler
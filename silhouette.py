@@ -0,0 +1,116 @@
+# -*- coding: utf8 -*-
+
+import math
+import multiprocessing
+
+import numpy as np
+
+from scipy import sparse
+from sklearn.metrics import pairwise_distances
+
+
+def _cluster_indicator(labels):
+    """Compact the labels to 0..k-1, and build the sparse n x k membership matrix and the cluster sizes."""
+    _, compact_labels = np.unique(labels, return_inverse=True)
+    n = len(compact_labels)
+    indicator = sparse.csr_matrix((np.ones(n), (np.arange(n), compact_labels)))
+    return compact_labels, indicator, np.bincount(compact_labels).astype(np.float64)
+
+
+def _silhouette_samples(X, rows, compact_labels, indicator, cluster_sizes, metric):
+    """Silhouette of the given rows against the whole data set. Memory is len(rows) x n distances."""
+    distances = pairwise_distances(X[rows], X, metric=metric)
+    # Sum of the distances of every row to the members of every cluster.
+    cluster_distances = np.asarray(indicator.T.dot(distances.T).T)
+    row_labels = compact_labels[rows]
+    row_index = np.arange(len(rows))
+    own_sizes = cluster_sizes[row_labels]
+
+    # The distance of a point to itself is 0, so the mean over the other members divides by size - 1.
+    a = cluster_distances[row_index, row_labels] / np.maximum(own_sizes - 1, 1)
+    cluster_distances /= cluster_sizes
+    cluster_distances[row_index, row_labels] = np.inf
+    b = cluster_distances.min(axis=1)
+    s = (b - a) / np.maximum(a, b)
+    # Points of singleton clusters have a silhouette of 0, as in sklearn.
+    s[own_sizes == 1] = 0.0
+    return np.nan_to_num(s)
+
+
+def _chunks(rows, chunk_size):
+    return [rows[i:i + chunk_size] for i in range(0, len(rows), chunk_size)]
+
+
+def sampled_silhouette(X, labels, sample_size=10000, metric='euclidean', confidence=0.95, random_state=0,
+                       chunk_size=1000):
+    """Estimate the Silhouette Coefficient from a stratified sample: every cluster is sampled in proportion to its
+       size (at least one point), and the silhouette of a sampled point is computed exactly against all points.
+       Returns (estimate, (lower, upper)), the normal confidence interval of the stratified mean."""
+    compact_labels, indicator, cluster_sizes = _cluster_indicator(labels)
+    n = len(compact_labels)
+    rng = np.random.RandomState(random_state)
+    sample_fraction = min(1.0, float(sample_size) / n)
+
+    strata = []
+    for cluster in range(len(cluster_sizes)):
+        members = np.flatnonzero(compact_labels == cluster)
+        size = max(1, int(round(len(members) * sample_fraction)))
+        strata.append(rng.choice(members, size, replace=False))
+    rows = np.concatenate(strata)
+    s = np.concatenate([_silhouette_samples(X, chunk, compact_labels, indicator, cluster_sizes, metric)
+                        for chunk in _chunks(rows, chunk_size)])
+
+    estimate, variance, start = 0.0, 0.0, 0
+    for cluster, stratum in enumerate(strata):
+        stratum_s = s[start:start + len(stratum)]
+        start += len(stratum)
+        weight = cluster_sizes[cluster] / n
+        estimate += weight * stratum_s.mean()
+        if len(stratum) > 1:
+            # Finite population correction, a fully sampled cluster adds no variance.
+            fpc = 1.0 - len(stratum) / cluster_sizes[cluster]
+            variance += weight ** 2 * stratum_s.var(ddof=1) / len(stratum) * fpc
+    z = _normal_quantile(0.5 + confidence / 2.0)
+    margin = z * math.sqrt(variance)
+    return estimate, (estimate - margin, estimate + margin)
+
+
+def _normal_quantile(p):
+    # Bisection on the normal CDF, scipy.stats is not needed for a single quantile.
+    low, high = -10.0, 10.0
+    for _ in range(100):
+        mid = (low + high) / 2.0
+        if 0.5 * math.erfc(-mid / math.sqrt(2.0)) < p:
+            low = mid
+        else:
+            high = mid
+    return (low + high) / 2.0
+
+
+# Set before the pool is forked, so the workers share the data instead of receiving a pickled copy.
+_shared = None
+
+
+def _silhouette_chunk(rows):
+    X, compact_labels, indicator, cluster_sizes, metric = _shared
+    return _silhouette_samples(X, rows, compact_labels, indicator, cluster_sizes, metric).sum()
+
+
+def exact_silhouette(X, labels, metric='euclidean', chunk_size=1000, processes=1):
+    """The exact Silhouette Coefficient (same value as sklearn.metrics.silhouette_score), computed chunk_size rows
+       at a time so memory is chunk_size x n distances per process, in a pool of worker processes if processes > 1."""
+    global _shared
+    compact_labels, indicator, cluster_sizes = _cluster_indicator(labels)
+    _shared = (X, compact_labels, indicator, cluster_sizes, metric)
+    chunks = _chunks(np.arange(len(compact_labels)), chunk_size)
+    try:
+        if processes > 1:
+            pool = multiprocessing.Pool(processes)
+            total = sum(pool.imap_unordered(_silhouette_chunk, chunks))
+            pool.close()
+            pool.join()
+        else:
+            total = sum(_silhouette_chunk(chunk) for chunk in chunks)
+    finally:
+        _shared = None
+    return total / len(compact_labels)
@@ -7,7 +7,10 @@ import logging.config
 import yaml
 import begin
 
+from time import time
 from gensim.models import Word2Vec, Phrases
+from corpus import iter_corpus
+from profiling import start_profiler
 
 
 class MySentences(object):
@@ -15,34 +18,70 @@ class MySentences(object):
         self.dirname = dirname
 
     def __iter__(self):
-        for root, _, files in os.walk(self.dirname):
-            for fn in files:
-                if fn.endswith('.txt'):
-                    filename = os.path.join(root, fn)
-                    f = codecs.open(filename, encoding='utf-8')
-                    for line in f.readlines():
-                        if line:
-                            line = line.strip()
-                            if line:
-                                yield line.split()
+        for _, f in iter_corpus(self.dirname):
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield line.split()
+
+
+def materialize_corpus(corpus_path, corpus_file, logger=None):
+    """Write the sentences of the corpus to corpus_file, one pre-tokenized sentence per line with the words
+       separated by single spaces (the LineSentence format of gensim's corpus_file training).
+       The file only appears once complete. Returns the number of sentences written."""
+    logger = logger if logger else logging.getLogger()
+    t0 = time()
+    tmp_file = corpus_file + '.tmp'
+    sentence_n = 0
+    with codecs.open(tmp_file, 'w', encoding='utf-8') as f:
+        for words in MySentences(corpus_path):
+            f.write(u'{}\n'.format(u' '.join(words)))
+            sentence_n += 1
+    os.rename(tmp_file, corpus_file)
+    logger.info('{} sentences written to {} in {:.1f}s'.format(sentence_n, corpus_file, time() - t0))
+    return sentence_n
 
 
 @begin.subcommand
-def train(corpus_path, model_path):
+def train(corpus_path, model_path, corpus_file=None, workers=16):
+    """Train the embeddings of the corpus. With --corpus-file, the corpus is first materialized into that line file
+       (unless it already exists) and gensim reads it directly, each worker thread from its own part of the file,
+       which keeps all the workers busy. Otherwise the sentences are streamed to gensim from one Python iterator."""
     with open('config/logging_config.yaml') as f:
         logging.config.dictConfig(yaml.load(f))
     logger = logging.getLogger()
 
-    sentences = MySentences(corpus_path)
+    workers = int(workers)
     # bigrams = Phrases(sentences, min_count=1)
     # trigrams = Phrases(bigrams[sentences], min_count=1)
-    model = Word2Vec(sentences, size=200, workers=16, sg=1, hs=0, negative=5, min_count=5)
-    model.save_word2vec_format(model_path, binary=True)
+    if corpus_file:
+        if os.path.exists(corpus_file):
+            logger.info('Training from the existing corpus file {}'.format(corpus_file))
+        else:
+            materialize_corpus(corpus_path, corpus_file, logger)
+        model = Word2Vec(corpus_file=corpus_file, size=200, workers=workers, sg=1, hs=0, negative=5, min_count=5)
+    else:
+        sentences = MySentences(corpus_path)
+        model = Word2Vec(sentences, size=200, workers=workers, sg=1, hs=0, negative=5, min_count=5)
+    # Word2Vec.save_word2vec_format moved to the KeyedVectors in later gensim versions.
+    if hasattr(model, 'wv'):
+        model.wv.save_word2vec_format(model_path, binary=True)
+    else:
+        model.save_word2vec_format(model_path, binary=True)
+
+
+@begin.subcommand
+def materialize(corpus_path, corpus_file):
+    """Only write the line file of --corpus-file training, e.g. to reuse it across several trainings."""
+    with open('config/logging_config.yaml') as f:
+        logging.config.dictConfig(yaml.load(f))
+    materialize_corpus(corpus_path, corpus_file, logging.getLogger())
 
 
 @begin.start
-def main():
-    pass
+def main(profile=None, profile_seconds=0, profile_mode='cprofile'):
+    if profile:
+        start_profiler(profile, float(profile_seconds), profile_mode)
 
 if begin.start():
     pass
@@ -1,15 +1,65 @@
 # -*- coding: utf8 -*-
 
 import time
+import logging
 import functools
 
+from metrics import metrics
+from profiling import active_profiler
+
+
+class _Timeit(object):
+    __slots__ = ('_name', '_profiler', '_t0')
+
+    def __init__(self, name, profiler):
+        self._name = name
+        self._profiler = profiler
+
+    def __enter__(self):
+        self._t0 = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        elapsed_time = time.time() - self._t0
+        metrics.observe(self._name, elapsed_time)
+        if self._profiler is not None:
+            self._profiler.record_timing(self._name, elapsed_time)
+        logger = logging.getLogger('timeit')
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('[%s] finished in %d ms', self._name, int(elapsed_time * 1000))
+        return False
+
+
+class _NullTimeit(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_null_timeit = _NullTimeit()
+
+
+def _timeit(name):
+    profiler = active_profiler()
+    if profiler is None and not metrics.enabled and not logging.getLogger('timeit').isEnabledFor(logging.DEBUG):
+        return _null_timeit
+    return _Timeit(name, profiler)
+
+
+def timeit(func_or_name):
+    """Time a function, as a decorator (@timeit), or a block, as a context manager (with timeit('name'):).
+       The elapsed time is added to the summary of the running profiler (see profiling.py) and to the metrics
+       (see metrics.py) under the function or block name, and logged by the timeit logger at DEBUG. When none of
+       them is on, timing is skipped. The return value of a decorated function is kept."""
+    if not callable(func_or_name):
+        return _timeit(func_or_name)
+    func = func_or_name
 
-def timeit(func):
     @functools.wraps(func)
     def newfunc(*args, **kwargs):
-        start_time = time.time()
-        func(*args, **kwargs)
-        elapsed_time = time.time() - start_time
-        print('Function [{}] finished in {} ms'.format(
-            func.__name__, int(elapsed_time * 1000)))
+        with _timeit(func.__name__):
+            return func(*args, **kwargs)
     return newfunc
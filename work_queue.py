@@ -0,0 +1,152 @@
+# -*- coding: utf8 -*-
+
+import os
+import time
+import sqlite3
+import logging
+
+from collections import namedtuple
+
+
+# A range of lines of a file, from the byte offset of its first line to the byte offset after its last line.
+Task = namedtuple('Task', ['id', 'path', 'start_line', 'end_line', 'start_offset', 'end_offset'])
+
+
+def iter_task_lines(task):
+    """Yield the lines of a task, decoded from utf-8, reading from the byte offset of the task.
+       Lines are split on line feeds only, as in WorkQueue.add_file (a codecs reader would also split on form feeds,
+       carriage returns, unicode line separators, ...)."""
+    with open(task.path, 'rb') as f:
+        if task.start_offset is None:
+            # Task of a queue created before the offsets were recorded.
+            for _ in xrange(task.start_line):
+                f.readline()
+        else:
+            f.seek(task.start_offset)
+        for _ in xrange(task.end_line - task.start_line):
+            line = f.readline()
+            if not line:
+                break
+            yield line.decode('utf-8')
+
+
+class WorkQueue(object):
+    """A SQLite-backed queue of sentence ranges shared by any number of local extraction workers.
+       A claimed task is leased to its worker for lease_seconds. The worker has to renew the lease with heartbeat(),
+       otherwise the task goes back to the queue and can be claimed by another worker."""
+
+    _pending = 'pending'
+    _leased = 'leased'
+    _done = 'done'
+
+    def __init__(self, db_file, lease_seconds=600, logger=None):
+        self.logger = logger if logger else logging.getLogger()
+        self._lease_seconds = int(lease_seconds)
+        # Autocommit mode, transactions are started explicitly where they are needed.
+        self._conn = sqlite3.connect(db_file, timeout=60, isolation_level=None)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS tasks (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                path TEXT NOT NULL,
+                start_line INTEGER NOT NULL,
+                end_line INTEGER NOT NULL,
+                start_offset INTEGER,
+                end_offset INTEGER,
+                status TEXT NOT NULL DEFAULT 'pending',
+                worker TEXT,
+                lease_expires REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                UNIQUE (path, start_line)
+            )
+        """)
+        columns = [row[1] for row in self._conn.execute('PRAGMA table_info(tasks)')]
+        if 'start_offset' not in columns:
+            self._conn.execute('ALTER TABLE tasks ADD COLUMN start_offset INTEGER')
+            self._conn.execute('ALTER TABLE tasks ADD COLUMN end_offset INTEGER')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, lease_expires)')
+
+    def close(self):
+        self._conn.close()
+
+    def add(self, path, start_line, end_line, start_offset=None, end_offset=None):
+        self._conn.execute('INSERT OR IGNORE INTO tasks (path, start_line, end_line, start_offset, end_offset) '
+                           'VALUES (?, ?, ?, ?, ?)', (path, start_line, end_line, start_offset, end_offset))
+
+    def add_file(self, path, chunk_size=1000):
+        """Split a file into tasks of chunk_size lines each, with the byte offset of every task so a worker can seek to
+           it. Returns the number of tasks."""
+        chunk_size = int(chunk_size)
+        # Byte offsets of the first line of every chunk, and of the end of the file.
+        line_n, offset, offsets = 0, 0, []
+        with open(path, 'rb') as f:
+            for line_n, line in enumerate(f, 1):
+                if (line_n - 1) % chunk_size == 0:
+                    offsets.append(offset)
+                offset += len(line)
+        offsets.append(offset)
+        tasks = [(path, start, min(start + chunk_size, line_n), offsets[i], offsets[i + 1])
+                 for i, start in enumerate(xrange(0, line_n, chunk_size))]
+        self._conn.execute('BEGIN IMMEDIATE')
+        try:
+            self._conn.executemany('INSERT OR IGNORE INTO tasks (path, start_line, end_line, start_offset, end_offset) '
+                                   'VALUES (?, ?, ?, ?, ?)', tasks)
+        except sqlite3.Error:
+            self._conn.execute('ROLLBACK')
+            raise
+        self._conn.execute('COMMIT')
+        return len(tasks)
+
+    def add_dir(self, data_dir, chunk_size=1000):
+        task_n = 0
+        for root, _, files in os.walk(data_dir):
+            for fn in files:
+                if fn.endswith('.txt'):
+                    task_n += self.add_file(os.path.join(root, fn), chunk_size)
+        return task_n
+
+    def claim(self, worker):
+        """Lease the next pending (or expired) task to the worker. Returns None if the queue is drained."""
+        now = time.time()
+        self._conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = self._conn.execute("""
+                SELECT id, path, start_line, end_line, start_offset, end_offset, status, worker FROM tasks
+                WHERE status = ? OR (status = ? AND lease_expires < ?)
+                ORDER BY id LIMIT 1
+            """, (self._pending, self._leased, now)).fetchone()
+            if row is None:
+                self._conn.execute('COMMIT')
+                return None
+            if row[6] == self._leased:
+                self.logger.warning(u'Lease of task {} held by {} expired, reclaiming it'.format(row[0], row[7]))
+            self._conn.execute("""
+                UPDATE tasks SET status = ?, worker = ?, lease_expires = ?, attempts = attempts + 1 WHERE id = ?
+            """, (self._leased, worker, now + self._lease_seconds, row[0]))
+        except sqlite3.Error:
+            self._conn.execute('ROLLBACK')
+            raise
+        self._conn.execute('COMMIT')
+        return Task(*row[:6])
+
+    def heartbeat(self, task_id, worker):
+        """Renew the lease. Returns False if the worker no longer holds the task."""
+        cur = self._conn.execute("""
+            UPDATE tasks SET lease_expires = ? WHERE id = ? AND worker = ? AND status = ?
+        """, (time.time() + self._lease_seconds, task_id, worker, self._leased))
+        return cur.rowcount == 1
+
+    def complete(self, task_id, worker):
+        cur = self._conn.execute("""
+            UPDATE tasks SET status = ?, lease_expires = NULL WHERE id = ? AND worker = ? AND status = ?
+        """, (self._done, task_id, worker, self._leased))
+        return cur.rowcount == 1
+
+    def release(self, task_id, worker):
+        """Give a task back to the queue without waiting for its lease to expire."""
+        cur = self._conn.execute("""
+            UPDATE tasks SET status = ?, worker = NULL, lease_expires = NULL WHERE id = ? AND worker = ? AND status = ?
+        """, (self._pending, task_id, worker, self._leased))
+        return cur.rowcount == 1
+
+    def stats(self):
+        return dict(self._conn.execute('SELECT status, COUNT(*) FROM tasks GROUP BY status').fetchall())